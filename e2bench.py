@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+""" benchmarks of ext2.py on generated ext2 images.
+
+The images are built from a generated tree with mke2fs -d, with a fixed
+UUID, hash seed and time, so runs on different commits (and machines)
+read the same layout (only inode ctimes, taken from the tree, differ):
+    deep/       a chain of 'depth' nested directories with small files
+    flat/       a directory with 'flat' files (htree-indexed)
+    big.bin     'big_mb' megabytes of data (double indirect blocks)
+    sparse.bin  a few extents up to 5 GiB apart (triple indirect blocks
+                on both 1K and 4K images), holes in between
+    links/      short (inline) and long (block) symlinks
+
+Usage:
+$ e2bench.py run [options] > results.json
+$ e2bench.py compare old.json new.json
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import struct
+import tempfile
+import platform
+import subprocess
+import optparse
+
+from ext2 import *
+
+# change this when the generated tree changes
+tree_version = 1
+
+fake_time = 1262304000     # 2010-01-01: mtimes, mke2fs and e2fsck time
+fs_uuid = '6e5a2a5e-0000-4000-8000-e2b3e2b3e2b3'
+seed = 20100101
+
+sparse_extents = [0, 300 * 1024, 70 * 1024 * 1024, 5 * 1024 * 1024 * 1024]
+sparse_extent_bytes = 64 * 1024
+
+default_params = {
+    'depth': 32,
+    'flat': 20000,
+    'big_mb': 16,
+    'links': 200,
+    'block_sizes': [1024, 4096],
+}
+
+
+def data_chunk(r, n):
+    """ 'n' pseudo-random bytes from random.Random 'r' """
+    return struct.pack('%dQ' % (n / 8),
+                       *[r.getrandbits(64) for i in xrange(n / 8)])
+
+
+def make_tree(root, params):
+    """ generate the source tree of the benchmark images in 'root' """
+    r = random.Random(seed)
+    os.makedirs(root)
+
+    d = os.path.join(root, 'deep')
+    for i in xrange(params['depth']):
+        d = os.path.join(d, 'level%02d' % i)
+        os.makedirs(d)
+        with open(os.path.join(d, 'file.txt'), 'wb') as f:
+            f.write('level %d\n' % i * (i + 1))
+
+    flat = os.path.join(root, 'flat')
+    os.makedirs(flat)
+    for i in xrange(params['flat']):
+        name = 'file-%06d-%s' % (i, 'x' * r.randrange(32))
+        with open(os.path.join(flat, name), 'wb') as f:
+            f.write(data_chunk(r, 8 * r.randrange(16)))
+
+    # the data of big.bin repeats a 64K chunk with a counter in every
+    # 4K, so that no two blocks are equal and generation is fast
+    chunk = bytearray(data_chunk(r, 64 * 1024))
+    with open(os.path.join(root, 'big.bin'), 'wb') as f:
+        for i in xrange(params['big_mb'] * 16):
+            for j in xrange(0, len(chunk), 4096):
+                struct.pack_into('Q', chunk, j, i * 16 + j / 4096)
+            f.write(chunk)
+
+    with open(os.path.join(root, 'sparse.bin'), 'wb') as f:
+        for offset in sparse_extents:
+            f.seek(offset)
+            f.write(data_chunk(r, sparse_extent_bytes))
+
+    links = os.path.join(root, 'links')
+    os.makedirs(links)
+    for i in xrange(params['links']):
+        if i % 2:
+            target = '../flat/file-%06d' % i
+        else:
+            target = '/'.join('component%04d' % j
+                              for j in xrange(r.randrange(5, 70)))
+        os.symlink(target, os.path.join(links, 'link%04d' % i))
+
+    for path, dirs, files in os.walk(root, topdown=False):
+        for name in files + dirs:
+            p = os.path.join(path, name)
+            if not os.path.islink(p):
+                os.utime(p, (fake_time, fake_time))
+        os.utime(path, (fake_time, fake_time))
+
+
+def image_kbytes(params):
+    """ size of the images in KB: it depends on the parameters only,
+    not on the file system the tree was generated on """
+    files = params['flat'] + params['links'] + 2 * params['depth']
+    return (32 * 1024 + params['big_mb'] * 1024 * 5 / 4 + files * 8 +
+            len(sparse_extents) * (sparse_extent_bytes / 1024 + 64))
+
+
+def make_image(root, img, blksz, params):
+    n = params['flat'] + params['links'] + 2 * params['depth'] + 16
+    env = dict(os.environ, E2FSPROGS_FAKE_TIME=str(fake_time),
+               E2FSCK_TIME=str(fake_time))
+    cmd = ['mke2fs', '-q', '-F', '-t', 'ext2', '-b', str(blksz),
+           '-N', str(n + 1024), '-U', fs_uuid,
+           '-E', 'hash_seed=%s,root_owner=0:0' % fs_uuid,
+           '-d', root, img, '%dk' % image_kbytes(params)]
+    devnull = open(os.devnull, 'w')
+    subprocess.check_call(cmd, env=env, stdout=devnull)
+    # mke2fs -d does not index directories, e2fsck -D does;
+    # exit code 1 means "file system modified"
+    if subprocess.call(['e2fsck', '-fyD', img], env=env,
+                       stdout=devnull, stderr=devnull) not in (0, 1):
+        raise Ext2Exception('e2fsck -D failed on %s' % img)
+
+
+def make_images(workdir, params):
+    """ build the images in 'workdir' unless they are already there,
+    return {name: image path} """
+    key = 'v%d-%d-%d-%d-%d' % (tree_version, params['depth'],
+                               params['flat'], params['big_mb'],
+                               params['links'])
+    images = {}
+    root = os.path.join(workdir, 'tree-' + key)
+    for blksz in params['block_sizes']:
+        img = os.path.join(workdir, 'bench-%s-%dk.img' % (key, blksz / 1024))
+        if not os.path.exists(img):
+            if not os.path.exists(root):
+                make_tree(root, params)
+            make_image(root, img + '.tmp', blksz, params)
+            os.rename(img + '.tmp', img)
+        images['%dk' % (blksz / 1024)] = img
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    return images
+
+
+class bench_context:
+    """ what the benchmarks need to know about an image """
+    def __init__(self, img, params, tmpdir):
+        self.img = img
+        self.params = params
+        self.tmpdir = tmpdir
+        fs = ext2fs(img)
+        self.flat = [e.name for e in fs._dir_by_inode(
+            fs._inode_by_path('/flat').index).ent if e.name[0] != '.']
+        self.links = ['/links/link%04d' % i for i in xrange(params['links'])]
+        self.deepest = '/deep/' + '/'.join(
+            'level%02d' % i for i in xrange(params['depth'])) + '/file.txt'
+        self.big_size = fs._inode_by_path('/big.bin').n_length
+        fs.umount()
+
+
+# Every benchmark is a function (ctx, fs) run on a freshly mounted
+# ext2fs (the mount is not timed). It returns the number of units done,
+# or (units, seconds) to time only a part of its work.
+
+def bench_mount(ctx, fs):
+    ext2fs(ctx.img).umount()
+    return 1
+
+
+def bench_lookup(ctx, fs):
+    r = random.Random(seed)
+    names = r.sample(ctx.flat, min(1000, len(ctx.flat)))
+    for name in names:
+        fs._inode_by_path('/flat/' + name)
+    fs._inode_by_path(ctx.deepest)
+    return len(names) + 1
+
+
+def bench_lookup_warm(ctx, fs):
+    bench_lookup(ctx, fs)
+    started = time.time()
+    n = bench_lookup(ctx, fs)
+    return n, time.time() - started
+
+
+def bench_ls(ctx, fs):
+    inode = fs._inode_by_path('/flat')
+    return len(fs._dir_by_inode(inode.index).ent)
+
+
+def bench_read_seq(ctx, fs):
+    inode = fs._inode_by_path('/big.bin')
+    chunk = 128 * 1024
+    done = 0
+    for offset in xrange(0, ctx.big_size, chunk):
+        done += len(fs.read(inode, offset, chunk))
+    return done
+
+
+def bench_read_random(ctx, fs):
+    inode = fs._inode_by_path('/big.bin')
+    r = random.Random(seed)
+    done = 0
+    for i in xrange(2000):
+        done += len(fs.read(inode, r.randrange(ctx.big_size), 4096))
+    return done
+
+
+def bench_read_sparse(ctx, fs):
+    inode = fs._inode_by_path('/sparse.bin')
+    done = 0
+    for offset in sparse_extents:
+        done += len(fs.read(inode, offset, sparse_extent_bytes))
+    return done
+
+
+def bench_readlink(ctx, fs):
+    for link in ctx.links:
+        fs.readlink(link)
+    return len(ctx.links)
+
+
+def bench_pull(ctx, fs):
+    done = 0
+    for name in ('big.bin', 'sparse.bin'):
+        to_file = os.path.join(ctx.tmpdir, name)
+        done += fs.pull('/' + name, to_file)[0]
+        os.remove(to_file)
+    return done
+
+
+benchmarks = [
+    # name, function, unit
+    ('mount', bench_mount, 'mounts'),
+    ('lookup', bench_lookup, 'lookups'),
+    ('lookup_warm', bench_lookup_warm, 'lookups'),
+    ('ls', bench_ls, 'entries'),
+    ('read_seq', bench_read_seq, 'bytes'),
+    ('read_random', bench_read_random, 'bytes'),
+    ('read_sparse', bench_read_sparse, 'bytes'),
+    ('readlink', bench_readlink, 'links'),
+    ('pull', bench_pull, 'bytes'),
+]
+
+
+def run_one(ctx, func, repeat):
+    runs = []
+    units = 0
+    for i in xrange(repeat):
+        fs = ext2fs(ctx.img)
+        started = time.time()
+        res = func(ctx, fs)
+        seconds = time.time() - started
+        if isinstance(res, tuple):
+            (units, seconds) = res
+        else:
+            units = res
+        fs.umount()
+        runs.append(seconds)
+    runs.sort()
+    return {'runs': runs, 'min': runs[0], 'median': runs[len(runs) / 2],
+            'units': units}
+
+
+def git_commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(opts):
+    params = dict(default_params)
+    params['flat'] = int(params['flat'] * opts.scale)
+    params['big_mb'] = max(1, int(params['big_mb'] * opts.scale))
+    workdir = opts.workdir or tempfile.mkdtemp(prefix='e2bench-')
+    tmpdir = tempfile.mkdtemp(prefix='e2bench-pull-')
+    only = opts.only.split(',') if opts.only else None
+    try:
+        images = make_images(workdir, params)
+        results = {}
+        for name in sorted(images):
+            ctx = bench_context(images[name], params, tmpdir)
+            results[name] = {}
+            for (bench, func, unit) in benchmarks:
+                if only and bench not in only:
+                    continue
+                res = run_one(ctx, func, opts.repeat)
+                res['unit'] = unit
+                results[name][bench] = res
+                sys.stderr.write('%s %-12s %10.6f s  %12.1f %s/s\n'
+                                 % (name, bench, res['median'],
+                                    res['units'] / max(res['median'], 1e-9),
+                                    unit))
+    finally:
+        shutil.rmtree(tmpdir)
+        if not opts.workdir:
+            shutil.rmtree(workdir)
+
+    return {'version': tree_version,
+            'commit': git_commit(),
+            'time': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': params,
+            'repeat': opts.repeat,
+            'results': results}
+
+
+def compare(old, new):
+    """ print median times of 'new' relative to 'old' """
+    print '%-4s %-12s %12s %12s %8s' % ('img', 'benchmark', 'old, s',
+                                        'new, s', 'new/old')
+    for img in sorted(new['results']):
+        for bench in sorted(new['results'][img]):
+            n = new['results'][img][bench]['median']
+            try:
+                o = old['results'][img][bench]['median']
+            except KeyError:
+                print '%-4s %-12s %12s %12.6f' % (img, bench, '-', n)
+                continue
+            print '%-4s %-12s %12.6f %12.6f %8.2f' % (img, bench, o, n,
+                                                      n / max(o, 1e-9))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.split('Usage:')[1])
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='runs of every benchmark, the median is reported')
+    parser.add_option('-s', '--scale', type='float', default=1.0,
+                      help='scale the flat directory and big.bin')
+    parser.add_option('-w', '--workdir',
+                      help='keep the generated images here between runs')
+    parser.add_option('--only', metavar='BENCH,...',
+                      help=', '.join(b[0] for b in benchmarks))
+    parser.add_option('-o', '--output', help='write results here')
+    (opts, args) = parser.parse_args(argv[1:])
+
+    if args[:1] == ['run'] and len(args) == 1:
+        results = json.dumps(run(opts), indent=1, sort_keys=True)
+        if opts.output:
+            with open(opts.output, 'w') as f:
+                f.write(results + '\n')
+        else:
+            print results
+    elif args[:1] == ['compare'] and len(args) == 3:
+        compare(json.load(open(args[1])), json.load(open(args[2])))
+    else:
+        parser.print_usage()
+        sys.exit(-1)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+""" a read-only consistency check of ext2 images (fsck-lite).
+
+It finds, without changing the image:
+    - descriptor and superblock counters which disagree with the bitmaps
+    - blocks claimed twice (by two inodes or by an inode and metadata)
+    - blocks in use but not claimed (leaked) and claimed but marked free
+    - inodes in use which no directory refers to (orphans), directories
+      which can't be reached from the root
+    - wrong link counts and i_blocks, '..' entries which don't point to
+      the parent, deleted inodes still marked in use
+    - broken directory entries: bad record lengths, entries pointing to
+      unused inodes, file types which don't match the inode
+
+Inode tables are scanned group by group (in several processes with -j),
+block ownership is kept in a bitmap of one bit per block.
+
+Usage:
+$ e2check.py [options] image
+The exit status is 0 for a clean image and 1 if problems were found.
+"""
+
+import sys
+import stat
+import time
+import struct
+import binascii
+import optparse
+import collections
+import multiprocessing
+
+from ext2 import *
+
+EXT2_RESIZE_INO = 7
+i_file_acl = e2inode.i_flds.index('i_file_acl')
+
+
+def parse_dir_block(buf, dir_ino, fileblock, res, filetype):
+    """ add entries of directory block 'buf' to res['refs'] as
+    (directory, name, inode, file type or None) """
+    offset = 0
+    while offset < len(buf):
+        try:
+            e = e2dentry(buf, offset)
+        except (Ext2Exception, struct.error) as err:
+            res['problems'].append('directory %d, block %d: %s'
+                                   % (dir_ino, fileblock, err))
+            return
+        if e.size % 4 or (e.inode and e2dentry.rec_len(e.namelen) > e.size):
+            res['problems'].append('directory %d, block %d: bad entry at '
+                                   'offset %d (size %d, name length %d)'
+                                   % (dir_ino, fileblock, offset, e.size,
+                                      e.namelen))
+            return
+        if e.inode:
+            res['refs'].append((dir_ino, e.name, e.inode,
+                                e.ftype if filetype else None))
+        offset += e.size
+
+
+def check_group(fs, group):
+    """ scan the used inodes of 'group'. Returns a dict of
+    'inodes': [(inode, mode, links)], 'claims': [(first block, length,
+    inode)], 'shared': [(xattr block, inode)], 'refs': directory entries
+    (see parse_dir_block) and 'problems'. """
+    res = {'inodes': [], 'claims': [], 'shared': [], 'refs': [],
+           'problems': []}
+    problems = res['problems']
+    blksz = fs.sb.block_size()
+    first_ino = fs.sb.d['s_first_ino'] if fs.sb.d['s_rev_level'] else 11
+    filetype = fs.sb.has_filetype()
+
+    def valid(first, count):
+        return fs.sb.boot_block <= first and \
+            first + count <= fs.sb.n_blocks
+
+    for inode in fs.iter_inodes([group], extents=True):
+        ino = inode.index
+        reserved = ino < first_ino and ino != fs.sb.root_dir_inode
+        if not reserved and (not inode.nlink or inode.dtime):
+            problems.append('inode %d: deleted (links %d, dtime %d), but '
+                            'marked in use' % (ino, inode.nlink, inode.dtime))
+            continue
+        if ino == EXT2_RESIZE_INO:
+            # its blocks are the reserved descriptor blocks, see claim_meta
+            dind = inode.block[e2inode.EXT2_NDIR_BLOCKS + 1]
+            if dind:
+                res['claims'].append((dind, 1, ino))
+            continue
+        if not reserved and stat.S_IFMT(inode.mode) not in stat_filetype:
+            problems.append('inode %d: invalid mode 0%o' % (ino, inode.mode))
+            continue
+        res['inodes'].append((ino, inode.mode, inode.nlink))
+
+        try:
+            ext = inode.extents()
+            meta = inode.indirect_blocks()
+        except (Ext2Exception, struct.error, IndexError) as err:
+            problems.append('inode %d: broken block map: %s' % (ino, err))
+            continue
+        used = len(meta)
+        for b in meta:
+            if valid(b, 1):
+                res['claims'].append((b, 1, ino))
+            else:
+                problems.append('inode %d: invalid indirect block %d'
+                                % (ino, b))
+        mapped = 0
+        for i in xrange(0, len(ext), 3):
+            if valid(ext[i + 1], ext[i + 2]):
+                res['claims'].append((ext[i + 1], ext[i + 2], ino))
+            else:
+                problems.append('inode %d: invalid blocks %d-%d'
+                                % (ino, ext[i + 1], ext[i + 1] + ext[i + 2]))
+            mapped += ext[i + 2]
+        used += mapped
+        acl = inode._raw[i_file_acl]
+        if acl:
+            used += 1
+            if valid(acl, 1):
+                res['shared'].append((acl, ino))
+            else:
+                problems.append('inode %d: invalid xattr block %d'
+                                % (ino, acl))
+        if inode.blocks != used * (blksz / 512):
+            problems.append('inode %d: i_blocks is %d, %d blocks are used'
+                            % (ino, inode.blocks, used))
+
+        if inode.is_directory():
+            if inode.n_length % blksz or mapped != inode.n_blocks():
+                problems.append('directory %d: size %d, %d blocks mapped'
+                                % (ino, inode.n_length, mapped))
+            for i in xrange(0, len(ext), 3):
+                log, phys, length = ext[i:i + 3]
+                if not valid(phys, length):
+                    continue
+                buf = str(fs.io.read_extent(length * blksz, phys * blksz))
+                for j in xrange(length):
+                    parse_dir_block(buf[j * blksz:(j + 1) * blksz], ino,
+                                    log + j, res, filetype)
+    return res
+
+
+def claim_meta(fs, claim):
+    """ claim superblock and descriptor copies, bitmaps and inode
+    tables of every group """
+    blksz = fs.sb.block_size()
+    gdt = (len(fs._bgd) * e2group_descriptor.gd_size + blksz - 1) / blksz
+    table = (fs.sb.inodes_in_grp * fs.sb.inode_size() + blksz - 1) / blksz
+    for g, bg in enumerate(fs._bgd):
+        if fs.sb.has_super(g):
+            claim(fs._group_blocks(g)[0],
+                  1 + gdt + fs.sb.d['s_reserved_gdt_blocks'], 0)
+        claim(bg.block_bitmap, 1, 0)
+        claim(bg.inode_bitmap, 1, 0)
+        claim(bg.inode_table, table, 0)
+
+
+def and_not(a, b):
+    """ bitmap of bits set in bitmap 'a' and not in bitmap 'b' """
+    if not a:
+        return bytearray()
+    x = int(binascii.hexlify(bytes(a)), 16) & \
+        ~int(binascii.hexlify(bytes(b)), 16)
+    return bytearray(binascii.unhexlify('%0*x' % (2 * len(a), x)))
+
+
+def bit_runs(bm, end):
+    """ yield (first bit, length) of runs of set bits among [0, end) """
+    i = bit_find(bm, 1, 0, end)
+    while i < end:
+        j = bit_find(bm, 0, i, end)
+        yield i, j - i
+        i = bit_find(bm, 1, j, end)
+
+
+def block_range(first, count):
+    if count == 1:
+        return 'block %d is' % first
+    return 'blocks %d-%d are' % (first, first + count - 1)
+
+
+def _check_init(filename, use_mmap):
+    global _fs
+    _fs = ext2fs(filename, use_mmap=use_mmap)
+
+
+def _check_group(group):
+    return check_group(_fs, group)
+
+
+def check(fs, processes=0):
+    """ check file system 'fs', scanning its groups in 'processes'
+    processes (in this one with 0). Returns a dict with 'problems' (a
+    list of messages) and numbers of 'inodes', 'dirs' and 'blocks'
+    (claimed by inodes) and 'seconds'. """
+    started = time.time()
+    report = fs.space_report()
+    problems = list(report['mismatches'])
+    first_ino = fs.sb.d['s_first_ino'] if fs.sb.d['s_rev_level'] else 11
+    if fs.sb.d['s_last_orphan']:
+        problems.append('superblock: the orphan list is not empty (%d)'
+                        % fs.sb.d['s_last_orphan'])
+
+    groups = xrange(len(fs._bgd))
+    pool = None
+    if processes > 0:
+        pool = multiprocessing.Pool(processes, _check_init,
+                                    (fs.filename, fs.io.map is not None))
+        results = pool.imap(_check_group, groups)
+    else:
+        results = (check_group(fs, g) for g in groups)
+
+    modes, links = {}, {}
+    claims, shared, refs = [], set(), []
+    try:
+        for g, res in enumerate(results):
+            dirs = 0
+            for ino, mode, nlink in res['inodes']:
+                modes[ino] = mode
+                links[ino] = nlink
+                dirs += stat.S_ISDIR(mode)
+            if dirs != fs._bgd[g].used_dirs:
+                problems.append('group %d: %d directories in the '
+                                'descriptor, %d found'
+                                % (g, fs._bgd[g].used_dirs, dirs))
+            claims.extend(res['claims'])
+            shared.update(b for (b, ino) in res['shared'])
+            refs.extend(res['refs'])
+            problems.extend(res['problems'])
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    # block ownership: bit b - s_first_data_block for block b
+    first = fs.sb.boot_block
+    own = bytearray((fs.sb.n_blocks - first + 7) / 8)
+    twice = set()
+
+    def claim(start, count):
+        rel = start - first
+        end = rel + count
+        i = bit_find(own, 1, rel, end)
+        while i < end:
+            twice.add(i + first)
+            i = bit_find(own, 1, i + 1, end)
+        set_bits(own, rel, count)
+
+    meta = []
+    claim_meta(fs, lambda start, count, ino: meta.append((start, count, 0)))
+    for start, count, ino in meta + claims:
+        claim(start, count)
+    for b in sorted(shared):
+        claim(b, 1)
+    if twice:
+        owners = collections.defaultdict(list)
+        for start, count, ino in meta + claims:
+            for b in xrange(start, start + count):
+                if b in twice:
+                    owners[b].append(ino or 'metadata')
+        for b in sorted(owners):
+            problems.append('block %d is claimed by %s' % (
+                b, ', '.join('inode %s' % o if o != 'metadata' else o
+                             for o in owners[b])))
+
+    for g in groups:
+        group_first, size = fs._group_blocks(g)
+        rel = (group_first - first) / 8
+        owned = own[rel:rel + (size + 7) / 8]
+        marked = fs._bitmap('b', g)[:len(owned)]
+        for start, count in bit_runs(and_not(marked, owned), size):
+            problems.append('%s marked in use, but not owned'
+                            % block_range(group_first + start, count))
+        for start, count in bit_runs(and_not(owned, marked), size):
+            problems.append('%s in use, but marked free'
+                            % block_range(group_first + start, count))
+
+    # names
+    count = collections.defaultdict(int)
+    parent, dotdot = {}, {}
+    subdirs = collections.defaultdict(list)
+    for dir_ino, name, ino, ftype in refs:
+        if ino not in modes:
+            problems.append('directory %d: "%s" points to unused inode %d'
+                            % (dir_ino, name, ino))
+            continue
+        count[ino] += 1
+        if ftype is not None and ftype != stat.S_IFMT(modes[ino]):
+            problems.append('directory %d: "%s" has the wrong file type'
+                            % (dir_ino, name))
+        if name == '.':
+            if ino != dir_ino:
+                problems.append('directory %d: "." points to inode %d'
+                                % (dir_ino, ino))
+        elif name == '..':
+            dotdot[dir_ino] = ino
+        elif stat.S_ISDIR(modes[ino]):
+            if ino in parent:
+                problems.append('directory %d is in directories %d and %d'
+                                % (ino, parent[ino], dir_ino))
+            parent[ino] = dir_ino
+            subdirs[dir_ino].append(ino)
+    parent[fs.sb.root_dir_inode] = fs.sb.root_dir_inode
+
+    # '.' and '..' count as links, so a directory unlinked from its
+    # parent still has some: follow entries from the root instead
+    connected = set([fs.sb.root_dir_inode])
+    queue = collections.deque(connected)
+    while queue:
+        for ino in subdirs[queue.popleft()]:
+            if ino not in connected:
+                connected.add(ino)
+                queue.append(ino)
+
+    for ino, mode in modes.iteritems():
+        if ino < first_ino and ino != fs.sb.root_dir_inode:
+            continue
+        if not count[ino]:
+            problems.append('inode %d is not in any directory' % ino)
+        elif count[ino] != links[ino]:
+            problems.append('inode %d: the link count is %d, %d links found'
+                            % (ino, links[ino], count[ino]))
+        if stat.S_ISDIR(mode) and ino not in connected:
+            problems.append('directory %d is not connected to the root'
+                            % ino)
+        if stat.S_ISDIR(mode) and ino in parent and \
+                dotdot.get(ino) != parent[ino]:
+            problems.append('directory %d: ".." points to %s, the parent is '
+                            '%d' % (ino, dotdot.get(ino, 'nothing'),
+                                    parent[ino]))
+
+    return {'problems': problems, 'inodes': len(modes),
+            'dirs': sum(1 for m in modes.itervalues() if stat.S_ISDIR(m)),
+            'blocks': sum(c for (s, c, i) in claims) + len(shared),
+            'seconds': time.time() - started}
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.split('Usage:')[1])
+    parser.add_option('-j', '--processes', type='int', default=0,
+                      help='scan block groups in this many processes')
+    parser.add_option('-m', '--max', type='int', default=100,
+                      help='print at most this many problems')
+    parser.add_option('--mmap', action='store_true',
+                      help='map the image into memory')
+    (opts, args) = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(-1)
+
+    fs = ext2fs(args[0], use_mmap=opts.mmap)
+    res = check(fs, opts.processes)
+    for message in res['problems'][:opts.max]:
+        print message
+    if len(res['problems']) > opts.max:
+        print '... %d more' % (len(res['problems']) - opts.max)
+    print('%s: %d inodes, %d directories, %d blocks, %d problems in %.2f s'
+          % (args[0], res['inodes'], res['dirs'], res['blocks'],
+             len(res['problems']), res['seconds']))
+    sys.exit(1 if res['problems'] else 0)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 
 import os
+import stat
 import errno
 import sys
+import time
+import collections
+import threading as T
+import types
+import json
 import fuse
 # import posix
 
@@ -11,6 +17,19 @@ from ext2 import *
 fuse.fuse_python_api = (0, 2)
 
 logfile = '/tmp/e2fuse.log'
+loglevel = 'warning'
+logsize = 16 * 1024 * 1024
+
+# the image is mounted read-only, so the kernel may cache attributes,
+# names and failed lookups for a long time (seconds, -o option=value)
+kernel_cache_timeouts = {
+    'attr_timeout': 3600,
+    'entry_timeout': 3600,
+    'negative_timeout': 3600,
+}
+
+# a hidden read-only file with statistics in JSON, not listed by readdir
+stats_path = '/.e2stats'
 
 usage = '''
 ext2 fuse filesystem
@@ -19,13 +38,189 @@ $ e2fuse.py </image/file> </mount/dir>
 ''' + fuse.Fuse.fusage
 
 
+class e2log:
+    """ leveled asynchronous log. Messages below 'level' cost one
+    comparison; the rest are queued unformatted in a ring buffer of
+    'ring_size' messages (the oldest are dropped when it is full) and
+    formatted and written by a background thread started with start().
+    The log file is rotated to 'path.1' ... 'path.<backups>' when it
+    grows over 'max_bytes'.
+    """
+    levels = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40,
+              'off': 100}
+
+    def __init__(self, path, level='warning', max_bytes=logsize,
+                 backups=2, ring_size=4096):
+        self.configure(path, level, max_bytes)
+        self.backups = backups
+        self.ring = collections.deque(maxlen=ring_size)
+        self.dropped = 0
+        self._wakeup = T.Event()
+        self._thread = None
+        self._stop = False
+        self._f = None
+
+    def configure(self, path, level, max_bytes):
+        if level not in self.levels:
+            raise ValueError('Unknown log level %s' % level)
+        self.path = path
+        self.level = self.levels[level]
+        self.max_bytes = max_bytes
+
+    def write(self, level, fmt, args):
+        if level < self.level:
+            return
+        if len(self.ring) == self.ring.maxlen:
+            self.dropped += 1
+        self.ring.append((time.time(), level, fmt, args))
+        self._wakeup.set()
+
+    def debug(self, fmt, *args):
+        self.write(10, fmt, args)
+
+    def info(self, fmt, *args):
+        self.write(20, fmt, args)
+
+    def warning(self, fmt, *args):
+        self.write(30, fmt, args)
+
+    def error(self, fmt, *args):
+        self.write(40, fmt, args)
+
+    def start(self):
+        """ start the writer thread: must be called after the daemon
+        forks, threads don't survive fork() """
+        if self._thread is None:
+            self._thread = T.Thread(target=self._drain)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._stop = True
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def _drain(self):
+        while not self._stop:
+            self._wakeup.wait(1.0)
+            self._wakeup.clear()
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        lines = []
+        while self.ring:
+            (t, level, fmt, args) = self.ring.popleft()
+            try:
+                msg = fmt % args if args else fmt
+            except (TypeError, ValueError) as e:
+                msg = '%s %% %r (%s)' % (fmt, args, e)
+            lines.append('%s.%03d %s\n' % (time.strftime('%H:%M:%S',
+                                                        time.localtime(t)),
+                                          int(t * 1000) % 1000, msg))
+        if self.dropped:
+            lines.append('(%d messages dropped)\n' % self.dropped)
+            self.dropped = 0
+        if not lines:
+            return
+        if self._f is None:
+            self._f = open(self.path, 'a')
+        self._f.write(''.join(lines))
+        self._f.flush()
+        if self._f.tell() > self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._f.close()
+        self._f = None
+        for i in range(self.backups, 0, -1):
+            older = '%s.%d' % (self.path, i - 1) if i > 1 else self.path
+            if os.path.exists(older):
+                os.rename(older, '%s.%d' % (self.path, i))
+        if not self.backups:
+            os.remove(self.path)
+
+
+def timed(method):
+    """ record the latency of an e2fuse operation in self.opstats;
+    negative results (-errno) and exceptions count as errors. Results
+    of generators (readdir) are timed until they are consumed. """
+    op = method.__name__
+
+    def timed_op(self, *args, **kw):
+        t = time.time()
+        failed = True
+        try:
+            res = method(self, *args, **kw)
+            if isinstance(res, types.GeneratorType):
+                res = _timed_items(self.opstats, op, t, res)
+                t = None
+            failed = isinstance(res, int) and res < 0
+            return res
+        finally:
+            if t is not None:
+                self.opstats.record(op, time.time() - t, failed)
+    timed_op.__name__ = op
+    timed_op.__doc__ = method.__doc__
+    return timed_op
+
+
+def _timed_items(opstats, op, t, items):
+    failed = True
+    try:
+        for item in items:
+            yield item
+        failed = False
+    except GeneratorExit:
+        failed = False      # the consumer stopped early
+        raise
+    finally:
+        opstats.record(op, time.time() - t, failed)
+
+
+class e2file:
+    """ an open file: keeps the resolved inode (with its block map)
+    so that reads don't walk the path again """
+    keep_cache = True   # the image is read-only, page cache stays valid
+
+    def __init__(self, inode):
+        self.inode = inode
+
+
+class e2statsfile:
+    """ an open stats_path: a snapshot of the statistics in JSON """
+    direct_io = True    # its size changes, the kernel must not cache it
+    keep_cache = False
+
+    def __init__(self, data):
+        self.data = data
+
+
+class e2dir:
+    """ an open directory: its entries, read once in opendir() """
+    def __init__(self, inode, entries):
+        self.inode = inode
+        self.ent = entries
+
+
 class e2fuse(fuse.Fuse):
+    stat_cache_size = 16384
+    readdir_batch = 256
+
     def __init__(self, *args, **kw):
         fuse.Fuse.__init__(self, *args, **kw)
-        self.logfile = open(logfile, 'w')
-        self.log('Starting e2fuse...')
+        self._stat_cache = e2lru(self.stat_cache_size)
+        self.opstats = e2opstats()
+        self.log = e2log(logfile, loglevel)
+        self.log.info('Starting e2fuse...')
 
     def fsinit(self):
+        self.log.start()
         if not hasattr(self, 'fs'):
             self._mount()
 
@@ -35,36 +230,65 @@ class e2fuse(fuse.Fuse):
         if imgf[0] is not '/':
             imgf = self.cwd + '/' + imgf
         try:
-            self.fs = ext2fs(imgf)
-            self.log('mounted successfully')
+            self.fs = ext2fs(imgf, use_mmap=self.conf['mmap'],
+                             index=self.conf['index'])
+            if self.fs.index_error:
+                self.log.warning('not using the index: %s',
+                                 self.fs.index_error)
+            self.log.info('mounted %s successfully', imgf)
         except Exception as e:
-            self.log('ext2fs(%s) failed: %s' % (imgf, e.message))
+            self.log.error('ext2fs(%s) failed: %s', imgf, e.message)
 
     def fsdestroy(self):
-        self.log('fsdestoy()')
+        self.log.info('fsdestoy()')
         self.fs.umount()
+        self.log.close()
+
+    def stats(self):
+        """ per-operation latencies, I/O counters and cache statistics,
+        see e2opstats.stats() and ext2fs.stats() """
+        st = self.fs.stats()
+        st['ops'] = self.opstats.stats()
+        st['stat_cache'] = self._stat_cache.stats()
+        return st
 
-    def log(self, msg):
-        self.logfile.write(msg + '\n')
+    def _stats_json(self):
+        return json.dumps(self.stats(), indent=1, sort_keys=True) + '\n'
 
+    @timed
     def getattr(self, path):
-        self.log('getattr("%s")' % path)
+        self.log.debug('getattr("%s")', path)
+        if path == stats_path:
+            st = fuse.Stat()
+            st.st_mode = stat.S_IFREG | 0444
+            st.st_nlink = 1
+            st.st_size = len(self._stats_json())
+            st.st_atime = st.st_mtime = st.st_ctime = int(time.time())
+            (st.st_uid, st.st_gid) = (os.getuid(), os.getgid())
+            return st
         try:
-            ent = self.fs._ent_by_path(path)
+            ino = self.fs._inode_by_path(path)
         except Ext2Exception:
-            self.log('  no "%s"' % path)
+            self.log.debug('  no "%s"', path)
             return -errno.ENOENT
 
-        self.log('  inode = %d' % ent.inode)
-        ino = self.fs._inode(ent.inode)
+        self.log.debug('  inode = %d', ino.index)
+        return self._stat(ino)
+
+    def _stat(self, ino):
+        """ fuse.Stat for e2inode 'ino', from the stat cache if possible:
+        the image is read-only, so cached attributes never go stale """
+        st = self._stat_cache.get(ino.index)
+        if st is not None:
+            return st
 
         st = fuse.Stat()
 
-        st.st_atime = ino.d['i_atime']
-        st.st_ctime = ino.d['i_ctime']
-        st.st_mtime = ino.d['i_mtime']
+        st.st_atime = ino.atime
+        st.st_ctime = ino.ctime
+        st.st_mtime = ino.mtime
 
-        st.st_ino = ent.inode
+        st.st_ino = ino.index
         if self.conf['user']:
             (st.st_uid, st.st_gid) = (os.getuid(), os.getgid())
         else:
@@ -72,96 +296,140 @@ class e2fuse(fuse.Fuse):
         st.st_mode = ino.mode
         st.st_nlink = ino.nlink
         st.st_size = ino.n_length
+        st.st_blocks = ino.blocks
         st.st_dev = 0
-        # self.log('  info: ' + str(dict(st)))
+        # self.log.debug('  info: %s', dict(st))
+        self._stat_cache.put(ino.index, st)
         return st
 
-    def readdir(self, path, offset):
-        self.log('readdir("%s")' % path)
-        dir_dentry = self.fs._ent_by_path(path)
-        d = self.fs._dir_by_inode(dir_dentry.inode)
-
-        dirents = []
-        for de in d.ent:
-            dirents.append(de.name)
-
-        self.log('  entries: %s' % str(dirents))
-        for r in dirents:
-            yield fuse.Direntry(r)
-
+    @timed
+    def readdir(self, path, offset, dh=None):
+        """ stream entries with their inode numbers and types; offsets
+        are entry indices, so listings can be resumed. Inodes of the
+        entries are loaded in batches, sorted by inode number, to prime
+        the stat cache for the getattr() calls which usually follow. """
+        self.log.debug('readdir("%s", %d)', path, offset)
+        if dh is None:
+            try:
+                inode = self.fs._inode_by_path(path)
+                dh = e2dir(inode, self.fs.dir_entries(inode.index))
+            except Ext2Exception as e:
+                self.log.debug('  Ext2Exception: %s', e.message)
+                return -errno.ENOENT
+        return self._readdir(dh, offset)
+
+    def _readdir(self, dh, offset):
+        self.log.debug('  %d entries', len(dh.ent))
+        for start in xrange(offset, len(dh.ent), self.readdir_batch):
+            batch = dh.ent[start:start + self.readdir_batch]
+            self.fs._prime_dcache(dh.inode.index, batch)
+            inodes = self.fs.load_inodes(e.inode for e in batch)
+            for i, e in enumerate(batch):
+                self._stat(inodes[e.inode])
+                yield fuse.Direntry(e.name, ino=e.inode, type=e.ftype,
+                                    offset=start + i + 1)
+
+    @timed
     def opendir(self, path):
-        self.log('opendir(%s)' % path)
-        return 0  # -errno.ENOSYS
+        self.log.debug('opendir(%s)', path)
+        try:
+            inode = self.fs._inode_by_path(path)
+            return e2dir(inode, self.fs.dir_entries(inode.index))
+        except Ext2Exception as e:
+            self.log.debug('  Ext2Exception: %s', e.message)
+            return -errno.ENOENT
 
-    def releasedir(self, path):
-        self.log('releasedir(%s)' % path)
-        return 0  # -errno.ENOSYS
+    @timed
+    def releasedir(self, path, dh=None):
+        self.log.debug('releasedir(%s)', path)
+        return 0
 
     def mknod(self, path, mode, dev):
-        self.log('mknod("%s", %o, %d")' % (path, mode, dev))
+        self.log.debug('mknod("%s", %o, %d")', path, mode, dev)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
 
     def unlink(self, path):
-        self.log('unlink("%s")' % path)
+        self.log.debug('unlink("%s")', path)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
 
-    def read(self, path, size, offset):
-        self.log('read(%s, %d, %d)' % (path, size, offset))
+    @timed
+    def read(self, path, size, offset, fh=None):
+        self.log.debug('read(%s, %d, %d)', path, size, offset)
         try:
-            buf = self.fs.read(path, offset, size)
-            self.log('  %d bytes read' % len(buf))
+            if fh is None and path == stats_path:
+                fh = e2statsfile(self._stats_json())
+            elif fh is None:
+                fh = e2file(self.fs._inode_by_path(path))
+            if isinstance(fh, e2statsfile):
+                return fh.data[offset:offset + size]
+            buf = self.fs.read(fh.inode, offset, size)
+            self.log.debug('  %d bytes read', len(buf))
             return buf
         except Ext2Exception as e:
-            self.log('  Ext2Exception: %s' % e.message)
+            self.log.warning('  Ext2Exception: %s', e.message)
             return ''
         # except Exception as e:
-        #     self.log('  Exception: %s' % e.message)
+        #     self.log.debug('  Exception: %s', e.message)
         #     return ''
 
-    def write(self, path, buf, offset):
-        self.log('write(%s, %d, %d)' % (path, len(buf), offset))
+    def write(self, path, buf, offset, fh=None):
+        self.log.debug('write(%s, %d, %d)', path, len(buf), offset)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
 
-    def release(self, path, flags):
+    @timed
+    def release(self, path, flags, fh=None):
+        self.log.debug('release(%s)', path)
         return 0
 
+    @timed
     def open(self, path, flags):
-        self.log('open(%s, 0x%x)' % (path, flags))
-        return 0  # -errno.ENOSYS
+        self.log.debug('open(%s, 0x%x)', path, flags)
+        if self.ro and flags & (os.O_WRONLY | os.O_RDWR):
+            return -errno.EROFS
+        if path == stats_path:
+            return e2statsfile(self._stats_json())
+        try:
+            return e2file(self.fs._inode_by_path(path))
+        except Ext2Exception as e:
+            self.log.debug('  Ext2Exception: %s', e.message)
+            return -errno.ENOENT
 
     def create(self, path, mode, umask):
-        self.log('create(%s, 0%o' % (path, mode))
+        self.log.debug('create(%s, 0%o', path, mode)
         if self.ro:
             return -errno.EROFS
         return 0
 
+    @timed
     def access(self, path, mode):
-        self.log('access(%s, 0%o)' % (path, mode))
+        self.log.debug('access(%s, 0%o)', path, mode)
+        if path == stats_path:
+            return 0
         try:
             self.fs._inode_by_path(path)
-            # self.log('  - granted')
+            # self.log.debug('  - granted')
             return 0
         except Ext2Exception as e:
-            self.log('  Ext2Exception: ' + e.message)
+            self.log.debug('  Ext2Exception: %s', e.message)
             return False
         except Exception as e:
-            self.log('  Exception: ' + e.message)
+            self.log.error('  Exception: %s', e.message)
             return False
 
     def truncate(self, path, size):
-        self.log('truncate(%s, %d)' % (path, size))
+        self.log.debug('truncate(%s, %d)', path, size)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
 
-    def ftruncate(self, fd, size):
-        self.log('ftruncate(%d, %d)' % (fd, size))
+    def ftruncate(self, path, size, fh=None):
+        self.log.debug('ftruncate(%s, %d)', path, size)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
@@ -172,43 +440,43 @@ class e2fuse(fuse.Fuse):
         return -errno.ENOSYS
 
     def mkdir(self, path, mode):
-        self.log('mkdir(%s)' % path)
+        self.log.debug('mkdir(%s)', path)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
 
     def rmdir(self, path):
-        self.log('rmdir(%s)' % path)
+        self.log.debug('rmdir(%s)', path)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
 
     def rename(self, pathfrom, pathto):
-        self.log('rename(%s, %s)' % (pathfrom, pathto))
+        self.log.debug('rename(%s, %s)', pathfrom, pathto)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
 
     def chown(self, path, uid, gid):
-        self.log('chown(%s, %d:%d)' % (path, uid, gid))
+        self.log.debug('chown(%s, %d:%d)', path, uid, gid)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
 
     def chmod(self, path, mode):
-        self.log('chmod(%s, 0%o)' % (path, mode))
+        self.log.debug('chmod(%s, 0%o)', path, mode)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
 
-    def fsync(self, path, isfsyncfile):
-        self.log('fsync(%s)' % path)
+    def fsync(self, path, isfsyncfile, fh=None):
+        self.log.debug('fsync(%s)', path)
         if self.ro:
             return -errno.EROFS
         return -errno.ENOSYS
 
-    def flush(self, path):
-        self.log('flush(%s)' % path)
+    def flush(self, path, fh=None):
+        self.log.debug('flush(%s)', path)
         return 0
 
     def link(self, ):
@@ -221,17 +489,19 @@ class e2fuse(fuse.Fuse):
             return -errno.EROFS
         return -errno.ENOSYS
 
+    @timed
     def readlink(self, path):
         link = self.fs.readlink(path)
-        self.log('readlink("%s") = %s' % (path, link))
+        self.log.debug('readlink("%s") = %s', path, link)
         return link
 
     def bmap(self, path):
-        self.log('bmap(%s)' % path)
+        self.log.debug('bmap(%s)', path)
         return -errno.ENOSYS
 
+    @timed
     def statvfs(self):
-        self.log('statfs()')
+        self.log.debug('statfs()')
         if not hasattr(self, 'fs'):
             self._mount()
 
@@ -251,11 +521,11 @@ class e2fuse(fuse.Fuse):
         return st
 
     def getxattr(self, path, name, param1):
-        self.log('getxattr(%s, %s, %d)' % (path, name, param1))
+        self.log.debug('getxattr(%s, %s, %d)', path, name, param1)
         return -errno.ENOSYS
 
     def listxattr(self, path, attr):
-        self.log('listxattr(%s)' % path)
+        self.log.debug('listxattr(%s)', path)
         return -errno.ENOSYS
 
 
@@ -263,6 +533,13 @@ def main(argv):
     fsserv = e2fuse(version="%prog "+fuse.__version__,
                     usage=usage, dash_s_do='setsingle')
     fsserv.parser.add_option(mountopt='user')
+    fsserv.parser.add_option(mountopt='mmap')
+    fsserv.parser.add_option(mountopt='loglevel', metavar='LEVEL',
+                             help='debug|info|warning|error|off')
+    fsserv.parser.add_option(mountopt='logfile', metavar='PATH')
+    fsserv.parser.add_option(mountopt='logsize', metavar='BYTES')
+    fsserv.parser.add_option(mountopt='index', metavar='PATH',
+                             help='an index made by "ext2.py IMG index"')
     fsserv.parse(values=fsserv, errex=1)
     fsserv.cwd = os.getcwd()
 
@@ -270,6 +547,22 @@ def main(argv):
     fsserv.conf = dict()
     fsserv.conf['ro'] = True
     fsserv.conf['user'] = ('user' in fsserv.fuse_args.optlist)
+    fsserv.conf['mmap'] = ('mmap' in fsserv.fuse_args.optlist)
+    def mountopt(name, default):
+        # registered mount options end up as attributes of 'values'
+        return getattr(fsserv, name, None) or \
+            fsserv.fuse_args.optdict.get(name, default)
+    index = mountopt('index', None)
+    fsserv.conf['index'] = index and os.path.abspath(index)
+    try:
+        fsserv.log.configure(mountopt('logfile', logfile),
+                             mountopt('loglevel', loglevel),
+                             int(mountopt('logsize', logsize)))
+    except ValueError as e:
+        print >> sys.stderr, e
+        sys.exit(-1)
+    for opt, timeout in kernel_cache_timeouts.items():
+        fsserv.fuse_args.optdict.setdefault(opt, str(timeout))
 
     try:
         print fsserv.fuse_args.mount_expected()
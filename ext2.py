@@ -5,7 +5,16 @@ import struct
 import stat
 import time
 import uuid
+import bisect
+import array
 import os
+import errno
+import fnmatch
+import mmap
+import collections
+import multiprocessing
+import re
+import sqlite3
 import threading as T
 
 __author__ = 'dmytrish'
@@ -54,8 +63,8 @@ stat_filetype = {
 struct.intsz = struct.calcsize('I')
 
 
-def unpack_struct(fmt, strct, s):
-    val_tuple = struct.unpack(fmt, s[:struct.calcsize(fmt)])
+def unpack_struct(fmt, strct, s, offset=0):
+    val_tuple = struct.unpack_from(fmt, s, offset)
     return dict(zip(strct, val_tuple))
 
 
@@ -63,6 +72,186 @@ def unpack_int_at(s, index):
     return struct.unpack_from('1I', s, index * struct.intsz)[0]
 
 
+def u32_array(s):
+    """ array('I') of all 32-bit integers in 's' """
+    a = array.array('I')
+    a.fromstring(s)
+    return a
+
+
+# bitmaps: bit i is (bm[i / 8] >> (i % 8)) & 1, as in ext2 bitmap blocks
+_not_all_ones = re.compile(b'[^\xff]')
+_not_all_zeros = re.compile(b'[^\x00]')
+
+
+def bit_find(bm, value, start, end):
+    """ index of the first bit equal to 'value' in bitmap 'bm' (a
+    bytearray) among bits [start, end), 'end' if there is none.
+    Whole bytes which don't match are skipped by a regex search. """
+    i = start
+    while i < end and i & 7:
+        if (bm[i >> 3] >> (i & 7)) & 1 == value:
+            return i
+        i += 1
+    if i >= end:
+        return end
+    m = (_not_all_ones if value == 0 else _not_all_zeros).search(
+        bm, i >> 3, (end + 7) >> 3)
+    if m is None:
+        return end
+    i = m.start() << 3
+    byte = bm[i >> 3] if value else ~bm[i >> 3]
+    while not (byte >> (i & 7)) & 1:
+        i += 1
+    return min(i, end)
+
+
+def bitmap_runs(bm, start, end):
+    """ yield (first bit, length) of runs of zero (free) bits of
+    bitmap 'bm' within bits [start, end) """
+    while start < end:
+        first = bit_find(bm, 0, start, end)
+        if first >= end:
+            return
+        start = bit_find(bm, 1, first, end)
+        yield first, start - first
+
+
+# byte -> number of its set bits, as a byte
+_popcount = bytes(bytearray(bin(i).count('1') for i in xrange(256)))
+
+
+def bit_count(bm, start, end):
+    """ number of set bits of bitmap 'bm' among bits [start, end).
+    Whole bytes are counted by translate() to their popcounts and
+    count() of every popcount value, both running in C. """
+    n = 0
+    while start < end and start & 7:
+        n += (bm[start >> 3] >> (start & 7)) & 1
+        start += 1
+    while start < end and end & 7:
+        end -= 1
+        n += (bm[end >> 3] >> (end & 7)) & 1
+    if start < end:
+        counts = bytes(bm[start >> 3:end >> 3]).translate(_popcount)
+        n += sum(k * counts.count(chr(k)) for k in xrange(1, 9))
+    return n
+
+
+def set_bits(bm, first, count, value=1):
+    """ set 'count' bits of bitmap 'bm' from 'first' to 'value' """
+    end = first + count
+    while first < end and first & 7:
+        bm[first >> 3] = (bm[first >> 3] & ~(1 << (first & 7))) | \
+            (value << (first & 7))
+        first += 1
+    full = (end - first) >> 3
+    if full > 0:
+        bm[first >> 3:(first >> 3) + full] = \
+            (b'\xff' if value else b'\x00') * full
+        first += full << 3
+    while first < end:
+        bm[first >> 3] = (bm[first >> 3] & ~(1 << (first & 7))) | \
+            (value << (first & 7))
+        first += 1
+
+
+def _libc_pread():
+    """ positional read functions from libc """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        c_pread = getattr(libc, 'pread64', None) or libc.pread
+    except (ImportError, OSError, AttributeError):
+        return None, None
+    c_pread.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                        ctypes.c_size_t, ctypes.c_int64]
+    c_pread.restype = ctypes.c_ssize_t
+
+    def check(n):
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return n
+
+    def pread(fd, count, offset):
+        buf = ctypes.create_string_buffer(count)
+        n = check(c_pread(fd, buf, count, offset))
+        return buf.raw[:n]
+
+    def preadinto(fd, buf, offset, start=0, count=None):
+        if count is None:
+            count = len(buf) - start
+        cbuf = (ctypes.c_char * count).from_buffer(buf, start)
+        return check(c_pread(fd, cbuf, count, offset))
+
+    return pread, preadinto
+
+
+def byte_view(obj, offset, count):
+    """ zero-copy read-only slice of 'obj' """
+    return buffer(obj, offset, count)
+
+
+pread, preadinto = _libc_pread()
+
+
+def _libc_copy():
+    """ copy_file_range() and sendfile() from libc, with the signatures
+    of the python 3 os functions """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (ImportError, OSError):
+        return {}
+    loff_p = ctypes.POINTER(ctypes.c_int64)
+
+    def check(n):
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return n
+
+    funcs = {}
+    c_copy = getattr(libc, 'copy_file_range', None)
+    if c_copy is not None:
+        c_copy.argtypes = [ctypes.c_int, loff_p, ctypes.c_int, loff_p,
+                           ctypes.c_size_t, ctypes.c_uint]
+        c_copy.restype = ctypes.c_ssize_t
+
+        def copy_file_range(src, dst, count, offset_src, offset_dst):
+            return check(c_copy(src, ctypes.byref(ctypes.c_int64(offset_src)),
+                                dst, ctypes.byref(ctypes.c_int64(offset_dst)),
+                                count, 0))
+        funcs['copy_file_range'] = copy_file_range
+
+    c_sendfile = getattr(libc, 'sendfile64', None) or \
+        getattr(libc, 'sendfile', None)
+    if c_sendfile is not None:
+        c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, loff_p,
+                               ctypes.c_size_t]
+        c_sendfile.restype = ctypes.c_ssize_t
+
+        def sendfile(out_fd, in_fd, offset, count):
+            return check(c_sendfile(out_fd, in_fd,
+                                    ctypes.byref(ctypes.c_int64(offset)),
+                                    count))
+        funcs['sendfile'] = sendfile
+    return funcs
+
+
+# kernel copy functions, where libc has them
+_kernel_copy = _libc_copy()
+# ways to copy data out of the image, the best first
+_copy_methods = [m for m in ('copy_file_range', 'sendfile')
+                 if m in _kernel_copy] + ['buffered']
+# errors which mean that a kernel copy method can't be used for the files
+_no_kernel_copy = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF,
+                   errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
 def time_format(unix_time):
     return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(unix_time))
 
@@ -71,103 +260,610 @@ class Ext2Exception(Exception):
     pass
 
 
+_missing = object()
+
+
+class e2lru:
+    """ a bounded mapping which evicts the least recently used values.
+    'capacity' limits the total cost of stored values, 'cost' estimates
+    the cost of one value (every value costs 1 by default).
+    """
+    def __init__(self, capacity, cost=None):
+        self.capacity = capacity
+        self._cost = cost or (lambda value: 1)
+        self._d = collections.OrderedDict()
+        self._lock = T.Lock()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._d)
+
+    def __contains__(self, key):
+        return key in self._d
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._d.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._d[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        cost = self._cost(value)
+        with self._lock:
+            if key in self._d:
+                self.used -= self._cost(self._d.pop(key))
+            if cost > self.capacity:
+                # too big to keep, but the old value must not stay
+                return
+            self._d[key] = value
+            self.used += cost
+            while self.used > self.capacity:
+                old_key, old_value = self._d.popitem(last=False)
+                self.used -= self._cost(old_value)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._d:
+                self.used -= self._cost(self._d.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._d.clear()
+            self.used = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions, 'entries': len(self._d),
+                'used': self.used, 'capacity': self.capacity}
+
+
+class e2opstats:
+    """ call counts, errors and latency histograms of operations.
+    Latencies go to power-of-two buckets of microseconds: bucket i
+    counts calls which took less than 2**i us (and at least 2**(i-1)).
+    """
+    n_buckets = 24      # the last one: 2**22 us (4 s) and longer
+
+    def __init__(self):
+        self._lock = T.Lock()
+        self._ops = {}
+
+    def record(self, op, seconds, failed=False):
+        us = int(seconds * 1000000)
+        bucket = min(us.bit_length(), self.n_buckets - 1)
+        with self._lock:
+            st = self._ops.get(op)
+            if st is None:
+                st = self._ops[op] = [0, 0, 0, 0, [0] * self.n_buckets]
+            st[0] += 1
+            st[1] += failed
+            st[2] += us
+            st[3] = max(st[3], us)
+            st[4][bucket] += 1
+
+    def reset(self):
+        with self._lock:
+            self._ops.clear()
+
+    def stats(self):
+        """ {op: {'calls', 'errors', 'total_us', 'max_us', 'histogram'}},
+        histograms are {'<N us': count} for non-empty buckets """
+        with self._lock:
+            ops = dict((op, list(st)) for (op, st) in self._ops.items())
+        res = {}
+        for op, (calls, errors, total, longest, buckets) in ops.items():
+            hist = {}
+            for i, n in enumerate(buckets):
+                if n:
+                    label = '<%d us' % (1 << i) \
+                        if i < self.n_buckets - 1 else '>=%d us' % (1 << i - 1)
+                    hist[label] = n
+            res[op] = {'calls': calls, 'errors': errors, 'total_us': total,
+                       'max_us': longest, 'histogram': hist}
+        return res
+
+
 class E2IO:
-    def __init__(self, source):
-        self.f = open(source, 'rb')
+    """ block-level access to an image.
+    Reads are positional (pread), so there is no shared file offset and
+    concurrent readers do not wait for each other; without pread reads
+    fall back to seek()+read() under a lock.
+    Blocks are kept in an LRU cache of at most 'cache_bytes' bytes,
+    cache_bytes=0 turns caching off.
+
+    With use_mmap=True the whole image is mapped into memory instead:
+    read_block() and read_at() return zero-copy views of the mapping
+    (buffer objects), the page cache of the kernel replaces the block
+    cache. Views support slicing, struct.unpack_from() and str().
+
+    Counters: block_reads (read_block() calls), syscalls and bytes_read
+    (reads of the image file), mapped_bytes (bytes viewed in the map).
+
+    With writable=True the image is opened for writing too, see
+    write_at(); written blocks replace their cached copies.
+    """
+    default_cache_bytes = 8 * 1024 * 1024
+
+    def __init__(self, source, cache_bytes=default_cache_bytes,
+                 use_mmap=False, writable=False):
+        self.writable = writable
+        self.f = open(source, 'r+b' if writable else 'rb')
+        self.fd = self.f.fileno()
         self._lock = T.Lock()
         self._b_lock = T.Lock()
+        self._pos = T.local()
+        self.cache = None
+        self.map = None
+        self.block_reads = 0
+        self.syscalls = 0
+        self.bytes_read = 0
+        self.mapped_bytes = 0
+        self.bytes_written = 0
+        if use_mmap:
+            try:
+                self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, OverflowError) as e:
+                self.f.close()
+                raise Ext2Exception('Cannot mmap %s: %s' % (source, e))
+        elif cache_bytes > 0:
+            self.cache = e2lru(cache_bytes, len)
         # self.blksz must be read from the file, so setting it later:
+        self.blksz = None
 
     def set_blksz(self, blksz):
         self.blksz = blksz
+        if self.cache is not None:
+            self.cache.clear()
 
     def close(self):
+        if self.map is not None:
+            self.map.close()
         self.f.close()
 
     def read_block(self, block_num):
-        self._b_lock.acquire()
-        self._go_to_block(block_num)
-        buf = self.f.read(self.blksz)
-        self._b_lock.release()
+        self.block_reads += 1
+        if self.map is not None:
+            return self._view(self.blksz, block_num * self.blksz)
+        if self.cache is not None:
+            buf = self.cache.get(block_num)
+            if buf is not None:
+                return buf
+        buf = self._pread(self.blksz, block_num * self.blksz)
+        if self.cache is not None:
+            self.cache.put(block_num, buf)
         return buf
 
     def read(self, count):
-        self._b_lock.acquire()
-        buf = self.f.read(count)
-        self._b_lock.release()
-        return buf
+        """ continue reading after the last read_at() of this thread """
+        return self.read_at(count, getattr(self._pos, 'offset', 0))
 
     def read_at(self, count, offset=0, whence=os.SEEK_SET):
-        self._b_lock.acquire()
-        self.f.seek(offset, whence)
-        buf = self.f.read(count)
-        self._b_lock.release()
+        if whence == os.SEEK_CUR:
+            offset += getattr(self._pos, 'offset', 0)
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self.fd).st_size
+        if self.map is not None:
+            buf = self._view(count, offset)
+        elif self.cache is not None and self.blksz:
+            buf = self._read_cached(count, offset)
+        else:
+            buf = self._pread(count, offset)
+        self._pos.offset = offset + len(buf)
         return buf
 
+    def readinto_at(self, buf, offset, start=0, count=None):
+        """ fill buf[start:start + count] (a bytearray or a memoryview of
+        one) with image bytes from 'offset', return the number of bytes
+        read """
+        if count is None:
+            count = len(buf) - start
+        done = 0
+        if self.map is None and preadinto is not None:
+            try:
+                done = preadinto(self.fd, buf, offset, start, count)
+                self.syscalls += 1
+                self.bytes_read += done
+            except TypeError:
+                pass    # this buffer type can't be passed to preadinto
+        if done < count:
+            if self.map is not None:
+                rest = self._view(count - done, offset + done)
+            else:
+                rest = self._pread(count - done, offset + done)
+            buf[start + done:start + done + len(rest)] = rest
+            done += len(rest)
+        return done
+
+    def read_extent(self, count, offset):
+        """ read 'count' bytes of file data at 'offset' with one read.
+        Data which fits in a block goes through the block cache, larger
+        extents bypass it so that they do not evict metadata. """
+        if self.map is not None:
+            return self._view(count, offset)
+        if self.cache is not None and self.blksz and \
+                offset / self.blksz == (offset + count - 1) / self.blksz:
+            return self._read_cached(count, offset)
+        return self._pread(count, offset)
+
+    def write_at(self, buf, offset):
+        """ write string 'buf' to the image at 'offset' """
+        if not self.writable:
+            raise Ext2Exception('The image is opened read-only')
+        with self._b_lock:
+            self.f.seek(offset)
+            self.f.write(buf)
+            self.f.flush()
+        self.syscalls += 3
+        self.bytes_written += len(buf)
+        if self.cache is not None and self.blksz and buf:
+            first = offset / self.blksz
+            last = (offset + len(buf) - 1) / self.blksz
+            for block_num in xrange(first, last + 1):
+                self.cache.discard(block_num)
+
+    def write_block(self, block_num, buf):
+        """ write a whole block and keep it in the block cache """
+        self.write_at(buf, block_num * self.blksz)
+        if self.cache is not None:
+            self.cache.put(block_num, str(buf))
+
+    def sync(self):
+        if self.writable:
+            self.f.flush()
+            os.fsync(self.fd)
+
+    def _view(self, count, offset):
+        count = max(0, min(count, len(self.map) - offset))
+        self.mapped_bytes += count
+        return byte_view(self.map, offset, count)
+
+    def _pread(self, count, offset):
+        if pread is None:
+            self._b_lock.acquire()
+            self.f.seek(offset)
+            buf = self.f.read(count)
+            self._b_lock.release()
+            self.syscalls += 2
+            self.bytes_read += len(buf)
+            return buf
+        buf = pread(self.fd, count, offset)
+        self.syscalls += 1
+        if 0 < len(buf) < count:
+            # short read: either the end of the image or interrupted
+            pieces = [buf]
+            done = len(buf)
+            while done < count:
+                piece = pread(self.fd, count - done, offset + done)
+                self.syscalls += 1
+                if not piece:
+                    break
+                pieces.append(piece)
+                done += len(piece)
+            buf = ''.join(pieces)
+        self.bytes_read += len(buf)
+        return buf
+
+    def _read_cached(self, count, offset):
+        if count <= 0:
+            return ''
+        first = offset / self.blksz
+        last = (offset + count - 1) / self.blksz
+        buf = ''.join(self.read_block(b) for b in xrange(first, last + 1))
+        start = offset - first * self.blksz
+        return buf[start:start + count]
+
+    def stats(self):
+        """ I/O counters and block cache counters """
+        st = {'block_reads': self.block_reads, 'syscalls': self.syscalls,
+              'bytes_read': self.bytes_read,
+              'mapped_bytes': self.mapped_bytes,
+              'bytes_written': self.bytes_written}
+        if self.cache is not None:
+            st['cache'] = self.cache.stats()
+        return st
+
     def lock(self): self._lock.acquire()
 
     def unlock(self): self._lock.release()
 
-    def _go_to_block(self, block_num):
-        self.f.seek(block_num * self.blksz)
+
+# directory hash functions of htree-indexed directories, as in e2fsprogs
+EXT2_HASH_LEGACY = 0
+EXT2_HASH_HALF_MD4 = 1
+EXT2_HASH_TEA = 2
+EXT2_HASH_LEGACY_UNSIGNED = 3
+EXT2_HASH_HALF_MD4_UNSIGNED = 4
+EXT2_HASH_TEA_UNSIGNED = 5
+
+_u32 = 0xffffffff
+
+
+def _hash_chars(name, unsigned):
+    chars = bytearray(name)
+    if unsigned:
+        return list(chars)
+    return [c - 256 if c > 127 else c for c in chars]
+
+
+def _dx_hack_hash(chars):
+    hash0, hash1 = 0x12a3fe2d, 0x37abe8f9
+    for c in chars:
+        h = (hash1 + (hash0 ^ (c * 7152373))) & _u32
+        if h & 0x80000000:
+            h = (h - 0x7fffffff) & _u32
+        hash1, hash0 = hash0, h
+    return (hash0 << 1) & _u32
+
+
+def _str2hashbuf(chars, num):
+    n = len(chars)
+    pad = (n | (n << 8)) & _u32
+    pad |= (pad << 16) & _u32
+    buf = []
+    val = pad
+    for i, c in enumerate(chars[:num * 4]):
+        val = (c + (val << 8)) & _u32
+        if i % 4 == 3:
+            buf.append(val)
+            val = pad
+    if len(buf) < num:
+        buf.append(val)
+    buf.extend([pad] * (num - len(buf)))
+    return buf
+
+
+def _rol(x, s):
+    return ((x << s) | (x >> (32 - s))) & _u32
+
+
+def _half_md4_transform(buf, d):
+    a, b, c, e = buf
+    k2, k3 = 0x5A827999, 0x6ED9EBA1
+
+    def f(x, y, z): return z ^ (x & (y ^ z))
+
+    def g(x, y, z): return (x & y) + ((x ^ y) & z)
+
+    def h(x, y, z): return x ^ y ^ z
+
+    for i, s in zip((0, 1, 2, 3, 4, 5, 6, 7), (3, 7, 11, 19) * 2):
+        a = _rol((a + f(b, c, e) + d[i]) & _u32, s)
+        a, b, c, e = e, a, b, c
+    for i, s in zip((1, 3, 5, 7, 0, 2, 4, 6), (3, 5, 9, 13) * 2):
+        a = _rol((a + g(b, c, e) + d[i] + k2) & _u32, s)
+        a, b, c, e = e, a, b, c
+    for i, s in zip((3, 7, 2, 6, 1, 5, 0, 4), (3, 9, 11, 15) * 2):
+        a = _rol((a + h(b, c, e) + d[i] + k3) & _u32, s)
+        a, b, c, e = e, a, b, c
+    return [(x + y) & _u32 for x, y in zip(buf, (a, b, c, e))]
+
+
+def _tea_transform(buf, d):
+    total = 0
+    b0, b1 = buf[0], buf[1]
+    for i in range(16):
+        total = (total + 0x9E3779B9) & _u32
+        b0 = (b0 + ((((b1 << 4) + d[0]) & _u32) ^ ((b1 + total) & _u32) ^
+                    ((b1 >> 5) + d[1]))) & _u32
+        b1 = (b1 + ((((b0 << 4) + d[2]) & _u32) ^ ((b0 + total) & _u32) ^
+                    ((b0 >> 5) + d[3]))) & _u32
+    return [(buf[0] + b0) & _u32, (buf[1] + b1) & _u32, buf[2], buf[3]]
+
+
+def dirhash(version, name, seed=None):
+    """ (hash, minor_hash) of a file name in an indexed directory """
+    buf = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+    if seed and any(seed):
+        buf = list(seed)
+    unsigned = version >= EXT2_HASH_LEGACY_UNSIGNED
+    chars = _hash_chars(name, unsigned)
+    minor_hash = 0
+    if version in (EXT2_HASH_LEGACY, EXT2_HASH_LEGACY_UNSIGNED):
+        h = _dx_hack_hash(chars)
+    elif version in (EXT2_HASH_HALF_MD4, EXT2_HASH_HALF_MD4_UNSIGNED):
+        for i in xrange(0, len(chars), 32):
+            buf = _half_md4_transform(buf, _str2hashbuf(chars[i:], 8))
+        h, minor_hash = buf[1], buf[2]
+    elif version in (EXT2_HASH_TEA, EXT2_HASH_TEA_UNSIGNED):
+        for i in xrange(0, len(chars), 16):
+            buf = _tea_transform(buf, _str2hashbuf(chars[i:], 4))
+        h, minor_hash = buf[0], buf[1]
+    else:
+        raise Ext2Exception('Unsupported directory hash version %d' % version)
+    return h & ~1 & _u32, minor_hash
 
 
-class e2dentry:
+class e2dentry(object):
+    """ a directory entry parsed from a directory block 'buf' at 'offset' """
     d_fmt = 'IHBB'
-    fmt_size = struct.calcsize(d_fmt)
+    d_struct = struct.Struct(d_fmt)
+    fmt_size = d_struct.size
     d_flds = ('d_inode', 'd_entry_size', 'd_namelen', 'd_filetype')
     stattype = [0, stat.S_IFREG, stat.S_IFDIR, stat.S_IFCHR,
                 stat.S_IFBLK, stat.S_IFIFO, stat.S_IFSOCK, stat.S_IFLNK]
+    __slots__ = ('inode', 'size', 'namelen', 'filetype', 'name', 'ftype')
 
-    def __init__(self, io, offset):
-        io.lock()
-        byte_array = io.read_at(self.fmt_size, offset)
-        self.d = unpack_struct(self.d_fmt, self.d_flds, byte_array)
-        self.inode = self.d['d_inode']
-        self.size = self.d['d_entry_size']
-
-        raw_name_size = self.size - struct.calcsize(self.d_fmt)
-        self.name = io.read(raw_name_size)
-        io.unlock()
-        self.name = self.name[: self.d['d_namelen']]
+    def __init__(self, buf, offset=0):
+        (self.inode, self.size, self.namelen, self.filetype) = \
+            self.d_struct.unpack_from(buf, offset)
+        if self.size < self.fmt_size or offset + self.size > len(buf):
+            raise Ext2Exception('Invalid dentry size %d at offset %d'
+                                % (self.size, offset))
+        start = offset + self.fmt_size
+        self.name = str(buf[start:start + self.namelen])
 
         try:
-            self.ftype = self.stattype[self.d['d_filetype']]
+            self.ftype = self.stattype[self.filetype]
         except IndexError:
             raise Ext2Exception(
                 'Invalid file type %d for dentry %s' %
-                (self.d['d_filetype'], self.name))
+                (self.filetype, self.name))
+
+    @staticmethod
+    def rec_len(namelen):
+        """ the smallest record size for a name of 'namelen' bytes """
+        return (e2dentry.fmt_size + namelen + 3) & ~3
 
+    @property
+    def d(self):
+        return dict(zip(self.d_flds, (self.inode, self.size,
+                                      self.namelen, self.filetype)))
 
-class e2directory:
-    def __init__(self, io, inode):
+
+class e2directory(object):
+    """ entries of a directory. Iterating over an e2directory streams
+    the entries block by block; 'ent' is the list of all entries.
+    Unused entries (with inode 0) are skipped.
+    Given the superblock 'sb', ent_by_name() uses the htree index of
+    indexed directories and reads only the index and one leaf block.
+    """
+    EXT2_INDEX_FL = 0x1000
+    dx_info_struct = struct.Struct('I4B')
+    dx_countlimit_struct = struct.Struct('2H')
+    dx_entry_struct = struct.Struct('2I')
+
+    def __init__(self, io, inode, sb=None):
         if not inode.is_directory():
-            raise Ext2Exception('Not a directory: ' % inode.name)
-        # TODO: directory might be more than 1 block
-        self.ent = []
-        bytes_read = 0
-        while bytes_read < io.blksz:
-            offset = (inode.block_at(0) * io.blksz) + bytes_read
-            e = e2dentry(io, offset)
-            self.ent.append(e)
-            bytes_read += e.d['d_entry_size']
+            raise Ext2Exception('Not a directory: inode %d' % inode.index)
+        self.io = io
+        self.inode = inode
+        self.sb = sb
+        self._ent = None
+
+    @property
+    def ent(self):
+        if self._ent is None:
+            self._ent = list(self._iter_entries())
+        return self._ent
+
+    def __iter__(self):
+        if self._ent is not None:
+            return iter(self._ent)
+        return self._iter_entries()
+
+    def _iter_entries(self):
+        blksz = self.io.blksz
+        n_blocks = (self.inode.n_length + blksz - 1) / blksz
+        for i in xrange(n_blocks):
+            buf = self.io.read_block(self.inode.block_at(i))
+            for e in self.parse_block(buf):
+                yield e
+
+    @staticmethod
+    def parse_block(buf):
+        """ iterate over used dentries in directory block 'buf' """
+        offset = 0
+        end = len(buf)
+        while offset < end:
+            e = e2dentry(buf, offset)
+            if e.inode:
+                yield e
+            offset += e.size
 
     def ent_by_name(self, name):
-        for e in self.ent:
+        if self._ent is None and self.is_indexed():
+            try:
+                return self._dx_lookup(name)
+            except Ext2Exception:
+                pass    # broken index: fall back to a linear scan
+        for e in self:
             if e.name == name:
                 return e
         return None
 
+    def is_indexed(self):
+        return (self.sb is not None and self.sb.has_dir_index() and
+                bool(self.inode.flags & self.EXT2_INDEX_FL))
+
+    def _dx_entries(self, buf, offset):
+        """ [(hash, logical block)] of a dx_root/dx_node at 'offset' """
+        limit, count = self.dx_countlimit_struct.unpack_from(buf, offset)
+        if not 0 < count <= limit or offset + 8 * limit > len(buf):
+            raise Ext2Exception('Invalid htree node in directory inode %d'
+                                % self.inode.index)
+        entries = [self.dx_entry_struct.unpack_from(buf, offset + 8 * i)
+                   for i in xrange(count)]
+        entries[0] = (0, entries[0][1])
+        return entries
+
+    def _dx_lookup(self, name):
+        root = self.io.read_block(self.inode.block_at(0))
+        (zero, hash_version, info_len, levels, flags) = \
+            self.dx_info_struct.unpack_from(root, 24)
+        if zero or levels > 2:
+            raise Ext2Exception('Unsupported htree in directory inode %d'
+                                % self.inode.index)
+        if hash_version <= EXT2_HASH_TEA and self.sb.unsigned_hash():
+            hash_version += EXT2_HASH_LEGACY_UNSIGNED
+        h = dirhash(hash_version, name, self.sb.hash_seed)[0]
+
+        # path of (entries, index) from the root down to the leaf level
+        path = []
+        entries = self._dx_entries(root, 24 + info_len)
+        while True:
+            i = bisect.bisect_right([e[0] for e in entries], h) - 1
+            path.append((entries, i))
+            if len(path) > levels:
+                break
+            node = self.io.read_block(self.inode.block_at(entries[i][1]))
+            entries = self._dx_entries(node, 8)
+
+        while True:
+            entries, i = path[-1]
+            leaf = self.io.read_block(self.inode.block_at(entries[i][1]))
+            for e in self.parse_block(leaf):
+                if e.name == name:
+                    return e
+            # names with colliding hashes may continue in the next leaf,
+            # its index entry has the same hash with the lowest bit set
+            next_hash = self._dx_next(path)
+            if next_hash is None or next_hash & ~1 != h:
+                return None
+
+    def _dx_next(self, path):
+        """ advance 'path' to the next leaf, return the hash of the index
+        entry which was advanced to or None if there are no more leaves """
+        level = len(path) - 1
+        while level >= 0 and path[level][1] + 1 >= len(path[level][0]):
+            level -= 1
+        if level < 0:
+            return None
+        entries, i = path[level]
+        path[level] = (entries, i + 1)
+        next_hash = entries[i + 1][0]
+        for lower in xrange(level + 1, len(path)):
+            entries, i = path[lower - 1]
+            node = self.io.read_block(self.inode.block_at(entries[i][1]))
+            path[lower] = (self._dx_entries(node, 8), 0)
+        return next_hash
+
     def ls(self):
-        for e in self.ent:
+        for e in self:
             line = stat_filetype[e.ftype]
             line += '\t' + str(e.inode)
             line += '\t' + e.name
             print line
 
 
-class e2inode:
-    i_fmt = '2H5I2H3I12I3I'
+class e2inode(object):
+    """ an inode record. The record is parsed with a precompiled
+    i_struct into slots; the dict 'd' of all fields is built on demand.
+    Block numbers are resolved lazily through the indirect blocks,
+    extents() builds the run-length map of the whole file.
+    """
+    i_fmt = '2H5I2H3I12I3I4I12s'
+    i_struct = struct.Struct(i_fmt)
     i_flds = (
         'i_mode',   'i_uid',    'i_size',
         # time
@@ -178,80 +874,142 @@ class e2inode:
         'i_db0', 'i_db1', 'i_db2', 'i_db3', 'i_db4', 'i_db5',
         'i_db6', 'i_db7', 'i_db8', 'i_db9', 'i_db10', 'i_db11',
         # single-, double-, tripple- indirect block pointers
-        'i_i1b', 'i_i2b', 'i_i3b'
+        'i_i1b', 'i_i2b', 'i_i3b',
+        'i_generation', 'i_file_acl', 'i_dir_acl', 'i_faddr', 'i_osd2'
     )
+    __slots__ = ('index', 'i_size', '_raw', 'uid', 'gid', 'n_length',
+                 'mode', 'nlink', 'atime', 'ctime', 'mtime', 'dtime',
+                 'blocks', 'flags', 'block', 'io', '_ind', '_extents')
     EXT2_NDIR_BLOCKS = 12
     EXT2_N_BLOCKS = 15
+    I_SIZE_HIGH = i_flds.index('i_dir_acl')   # for regular files
+    indirect_cache_size = 4
 
-    def __init__(self, ino_num, io, offset, inosz):
+    def __init__(self, ino_num, io, offset, inosz, buf=None):
+        """ read inode #ino_num at image 'offset', or parse it at 'offset'
+        of an already read inode table buffer 'buf' """
         self.index = ino_num
         self.i_size = inosz
-        byte_array = io.read_at(self.i_size, offset)
-        self.d = unpack_struct(self.i_fmt, self.i_flds, byte_array)
-
-        self.uid = self.d['i_uid']
-        self.gid = self.d['i_gid']
-        self.n_length = self.d['i_size']
-        self.mode = self.d['i_mode']
-        self.nlink = self.d['i_links_count']
-
-        if not self.is_short_link():
-            self.block_list = self._build_block_list(io)
-
-    def _build_block_list(self, io):
-        """return list of absolute block addresses for the inode"""
-        def list_of_indirects(ib):
-            bl = []
-            for i in xrange(io.blksz / struct.intsz):
-                bn = unpack_int_at(ib, i)
-                if bn is 0:
-                    return bl
-                bl.append(bn)
-            return bl
-
-        def list_of_double_indirects(dib):
-            dibl = []
-            for i in xrange(io.blksz / struct.intsz):
-                ibn = unpack_int_at(dib, i)
-                if ibn is 0:
-                    return dibl
-                ib = io.read_block(ibn)
-                dibl.extend(list_of_indirects(ib))
-            return dibl
+        if buf is None:
+            buf = io.read_at(self.i_struct.size, offset)
+            offset = 0
+        raw = self.i_struct.unpack_from(buf, offset)
+        self._raw = raw
+
+        (self.mode, self.uid, self.n_length, self.atime, self.ctime,
+         self.mtime, self.dtime, self.gid, self.nlink, self.blocks,
+         self.flags) = raw[:11]
+        self.block = raw[12:12 + self.EXT2_N_BLOCKS]
+        if stat.S_ISREG(self.mode):
+            self.n_length |= raw[self.I_SIZE_HIGH] << 32
+
+        self.io = io
+        self._ind = None
+        self._extents = None
+
+    def n_blocks(self):
+        """ number of logical blocks covered by the file size """
+        if self.is_short_link() or self.is_device():
+            return 0
+        return (self.n_length + self.io.blksz - 1) / self.io.blksz
+
+    def _indirect(self, block_num):
+        """ block numbers from indirect block 'block_num', decoded at once
+        and kept in a small per-inode cache, made on first use """
+        if self._ind is None:
+            self._ind = {}
+        ptrs = self._ind.get(block_num)
+        if ptrs is None:
+            ptrs = u32_array(self.io.read_block(block_num))
+            if len(self._ind) >= self.indirect_cache_size:
+                self._ind.clear()
+            self._ind[block_num] = ptrs
+        return ptrs
+
+    def _map(self, fileblock):
+        """ resolve 'fileblock' through the indirect tree, 0 if unmapped """
+        if fileblock < self.EXT2_NDIR_BLOCKS:
+            return self.block[fileblock]
+        per_block = self.io.blksz / struct.intsz
+        fileblock -= self.EXT2_NDIR_BLOCKS
+        for level in (1, 2, 3):
+            span = per_block ** level
+            if fileblock < span:
+                ptr = self.block[self.EXT2_NDIR_BLOCKS + level - 1]
+                while ptr and span > 1:
+                    span /= per_block
+                    ptr = self._indirect(ptr)[fileblock / span]
+                    fileblock %= span
+                return ptr
+            fileblock -= span
+        return 0
+
+    def _iter_pointers(self, n_blocks, meta=None):
+        """ yield (first logical block, array of block numbers) chunks
+        for the first 'n_blocks' blocks, skipping unmapped subtrees.
+        The indirect blocks walked through are appended to list 'meta'. """
+        per_block = self.io.blksz / struct.intsz
+
+        def walk(ptr, level, start):
+            if start >= n_blocks:
+                return
+            if not ptr:
+                return
+            if meta is not None:
+                meta.append(ptr)
+            ptrs = self._indirect(ptr)
+            if level == 1:
+                yield start, ptrs[:n_blocks - start]
+                return
+            span = per_block ** (level - 1)
+            for i, p in enumerate(ptrs):
+                if start + i * span >= n_blocks:
+                    break
+                for chunk in walk(p, level - 1, start + i * span):
+                    yield chunk
+
+        yield 0, array.array('I', self.block[:min(n_blocks,
+                                                  self.EXT2_NDIR_BLOCKS)])
+        start = self.EXT2_NDIR_BLOCKS
+        for level in (1, 2, 3):
+            for chunk in walk(self.block[self.EXT2_NDIR_BLOCKS + level - 1],
+                              level, start):
+                yield chunk
+            start += per_block ** level
+
+    def extents(self):
+        """ run-length map of the file: a flat array('I') of
+        (logical block, physical block, length) triples; unmapped
+        blocks are not covered by any extent """
+        if self._extents is None:
+            ext = array.array('I')
+            log = phys = length = 0
+            for start, ptrs in self._iter_pointers(self.n_blocks()):
+                for i, p in enumerate(ptrs):
+                    if length and p == phys + length and \
+                            start + i == log + length:
+                        length += 1
+                        continue
+                    if length:
+                        ext.extend((log, phys, length))
+                        length = 0
+                    if p:
+                        log, phys, length = start + i, p, 1
+            if length:
+                ext.extend((log, phys, length))
+            self._extents = ext
+        return self._extents
+
+    def indirect_blocks(self):
+        """ list of the indirect blocks which map the file """
+        meta = []
+        for chunk in self._iter_pointers(self.n_blocks(), meta):
+            pass
+        return meta
 
-        blocks = []
-        for i in range(e2inode.EXT2_NDIR_BLOCKS):
-            block_num = self.d['i_db' + str(i)]
-            if block_num == 0:
-                return blocks
-            blocks.append(block_num)
-
-        i1b_num = self.d['i_i1b']
-        if i1b_num is 0:
-            return blocks
-        i1b = io.read_block(i1b_num)
-        blocks.extend(list_of_indirects(i1b))
-
-        i2b_num = self.d['i_i2b']
-        if i2b_num is 0:
-            return blocks
-        i2b = io.read_block(i2b_num)
-        blocks.extend(list_of_double_indirects(i2b))
-
-        i3b_num = self.d['i_i3b']
-        if i3b_num is 0:
-            return blocks
-        i3b = io.read_block(i3b_num)
-        for i in xrange(io.blksz / struct.intsz):
-            dibn = unpack_int_at(i3b, i)
-            if dibn is 0:
-                return blocks
-            dib = io.read_block(dibn)
-            blocks.extend(list_of_double_indirects(dib))
-
-        print 'it''s kinda strange to reach this point'
-        print 'is the inode really that long?'
-        return blocks
+    @property
+    def d(self):
+        return dict(zip(self.i_flds, self._raw))
 
     def get_mode(self):
         rights = ''
@@ -272,47 +1030,102 @@ class e2inode:
         return stat.S_IFMT(self.mode) == stat.S_IFLNK
 
     def is_short_link(self):
-        if self.n_length > struct.intsz * self.EXT2_N_BLOCKS:
+        # targets of 60 bytes and more don't fit in i_block with the
+        # terminating zero, they are kept in a data block
+        if self.n_length >= struct.intsz * self.EXT2_N_BLOCKS:
             return False
         return self.is_link()
 
     def block_at(self, fileblock):
         ''' absolute block number from relative in-file block number '''
-        try:
-            return self.block_list[fileblock]
-        except IndexError:
+        block_num = 0
+        if 0 <= fileblock < self.n_blocks():
+            block_num = self._map(fileblock)
+        if not block_num:
             raise Ext2Exception('Invalid file block number %d for inode %d'
                                 % (fileblock, self.index))
+        return block_num
+
+    def runs(self, first, count):
+        """ yield (logical block, physical block, length) of runs of
+        physically contiguous blocks among 'count' blocks from 'first';
+        runs of unmapped blocks have physical block 0. The block map is
+        used when it is ready (see extents()), the indirect blocks are
+        read otherwise. """
+        if self._extents is not None:
+            for run in self._extent_runs(first, count):
+                yield run
+            return
+        n_blocks = self.n_blocks()
+        log = phys = length = 0
+        for fileblock in xrange(first, first + count):
+            p = 0
+            if fileblock < n_blocks:
+                p = self._map(fileblock)
+            if length and (p == phys + length if phys else not p):
+                length += 1
+                continue
+            if length:
+                yield log, phys, length
+            log, phys, length = fileblock, p, 1
+        if length:
+            yield log, phys, length
+
+    def _extent_runs(self, first, count):
+        """ runs() from the block map """
+        ext = self._extents
+        # the first extent which ends after 'first'
+        lo, hi = 0, len(ext) / 3
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if ext[3 * mid] + ext[3 * mid + 2] <= first:
+                lo = mid + 1
+            else:
+                hi = mid
+        pos, end = first, first + count
+        for i in xrange(3 * lo, len(ext), 3):
+            log, phys, length = ext[i], ext[i + 1], ext[i + 2]
+            if log >= end:
+                break
+            if log > pos:
+                yield pos, 0, log - pos
+                pos = log
+            n = min(log + length, end) - pos
+            yield pos, phys + pos - log, n
+            pos += n
+        if pos < end:
+            yield pos, 0, end - pos
 
     def get_block_list(self):
-        return self.block_list
+        """ list of absolute addresses of the mapped blocks, in file order """
+        ext = self.extents()
+        blocks = []
+        for i in xrange(0, len(ext), 3):
+            blocks.extend(xrange(ext[i + 1], ext[i + 1] + ext[i + 2]))
+        return blocks
 
     def blocks_as_string(self):
         """ this method is used for reading in-place links, up to 60 chars """
         s = ''
-        for i in range(e2inode.EXT2_N_BLOCKS):
-            if i < e2inode.EXT2_NDIR_BLOCKS:
-                b = self.d['i_db' + str(i)]
-            else:
-                b = self.d['i_i%db' % (1 + i - e2inode.EXT2_NDIR_BLOCKS)]
+        for b in self.block:
             if b == 0:
                 break
             s += struct.pack('I', b)
         return s.strip('\0')
 
     def device_id(self):
-        dev = self.d['i_db0']
+        dev = self.block[0]
         return (os.major(dev), os.minor(dev))
 
     def __str__(self):
         res = self.get_mode()
-        res += ' %3d' % self.d['i_links_count']
+        res += ' %3d' % self.nlink
         res += ' %4d:%d\t' % (self.uid, self.gid)
         if self.is_device():  # devices need DevID formatting
             res += '     (%2d,%2d)' % self.device_id()
         else:
             res += ' %10d' % self.n_length
-        res += ' %s' % time_format(self.d['i_ctime'])
+        res += ' %s' % time_format(self.ctime)
         return res
 
 
@@ -334,26 +1147,96 @@ class e2group_descriptor:
         self.check_range(self.inode_bitmap, 'inodebitmap')
         self.check_range(self.inode_table, 'inodetable')
 
-    def __init__(self, fs, offset, index):
+    def __init__(self, fs, offset, index, buf=None, buf_offset=0):
+        """ descriptor #index of the table at image 'offset', read from
+        the image or parsed at 'buf_offset' of an already read 'buf' """
         self.index = index
-        byte_array = fs.io.read_at(self.gd_size, offset + index * self.gd_size)
-        self.d = unpack_struct(self.gd_fmt, self.gd_flds, byte_array)
+        self.offset = offset + index * self.gd_size
+        if buf is None:
+            buf = fs.io.read_at(self.gd_size, self.offset)
+            buf_offset = 0
+        self.d = unpack_struct(self.gd_fmt, self.gd_flds, buf, buf_offset)
         self.block_bitmap = self.d['bg_block_bitmap']
         self.inode_bitmap = self.d['bg_inode_bitmap']
         self.inode_table = self.d['bg_inode_table']
+        self.free_blocks = self.d['bg_free_blocks_count']
+        self.free_inodes = self.d['bg_free_inodes_count']
+        self.used_dirs = self.d['bg_used_dirs_count']
 
         self.start = fs.sb.boot_block + self.index * fs.sb.blocks_in_grp
         self.end = self.start + fs.sb.blocks_in_grp
 
         self.check()
 
+    def pack(self):
+        """ the descriptor fields with the current counters """
+        return struct.pack(self.gd_fmt, self.block_bitmap, self.inode_bitmap,
+                           self.inode_table, self.free_blocks,
+                           self.free_inodes, self.used_dirs)
+
+
+class e2group_table(object):
+    """ the table of 'count' block group descriptors at image 'offset'.
+    Nothing is read up front: a descriptor is parsed (and checked) when
+    it is first used, from the block of the table which holds it.
+    Iterating over the table reads its missing blocks with one read.
+    Parsed descriptors are kept, so changes to their counters stay.
+    """
+    def __init__(self, fs, offset, count):
+        self.fs = fs
+        self.offset = offset
+        self.count = count
+        self._blksz = fs.sb.block_size()
+        self._per_block = self._blksz / e2group_descriptor.gd_size
+        # raw blocks of the table, None until read:
+        self._blocks = [None] * ((count + self._per_block - 1) /
+                                 self._per_block)
+        self._gd = {}
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        gd = self._gd.get(index)
+        if gd is None:
+            if not 0 <= index < self.count:
+                raise IndexError('No block group %d' % index)
+            block, i = divmod(index, self._per_block)
+            buf = self._blocks[block]
+            if buf is None:
+                buf = str(self.fs.io.read_block(self.offset / self._blksz +
+                                                block))
+                self._blocks[block] = buf
+            gd = e2group_descriptor(self.fs, self.offset, index, buf,
+                                    i * e2group_descriptor.gd_size)
+            self._gd[index] = gd
+        return gd
+
+    def __iter__(self):
+        self.load()
+        for i in xrange(self.count):
+            yield self[i]
+
+    def load(self):
+        """ read the blocks of the table which are not read yet, from
+        the first to the last of them, at once """
+        missing = [i for (i, b) in enumerate(self._blocks) if b is None]
+        if not missing:
+            return
+        first, last = missing[0], missing[-1] + 1
+        buf = str(self.fs.io.read_extent((last - first) * self._blksz,
+                                         self.offset + first * self._blksz))
+        for i in missing:
+            start = (i - first) * self._blksz
+            self._blocks[i] = buf[start:start + self._blksz]
+
 
 class e2superblock:
     file_offset = 1024
     sb_size = 1024
     ext2magic = 0xef53
     root_dir_inode = 2
-    sb_fmt = '13I6H4I2HI2H3I16s16s64sI2B'
+    sb_fmt = '13I6H4I2HI2H3I16s16s64sI2BH16s3I16s2BH3I68s3I2HI'
     sb_keys = (
         's_inodes_count',      's_blocks_count',          's_r_blocks_count',
         's_free_blocks_count', 's_free_inodes_count',     's_first_data_block',
@@ -367,8 +1250,25 @@ class e2superblock:
         's_block_group_nr',    's_feature_compat',        's_feature_incompat',
         's_feature_ro_compat', 's_uuid',                  's_volume_name',
         's_last_mounted',      's_algorithm_usage_bitmap', 's_prealloc_block',
-        's_prealloc_dir_blocks'
+        's_prealloc_dir_blocks', 's_reserved_gdt_blocks',  's_journal_uuid',
+        's_journal_inum',      's_journal_dev',           's_last_orphan',
+        's_hash_seed',         's_def_hash_version',      's_jnl_backup_type',
+        's_desc_size',         's_default_mount_opts',    's_first_meta_bg',
+        's_mkfs_time',         's_jnl_blocks',            's_blocks_count_hi',
+        's_r_blocks_count_hi', 's_free_blocks_hi',        's_min_extra_isize',
+        's_want_extra_isize',  's_flags'
     )
+    EXT2_FEATURE_COMPAT_DIR_INDEX = 0x0020
+    EXT2_FEATURE_INCOMPAT_FILETYPE = 0x0002
+    EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER = 0x0001
+    EXT2_FEATURE_RO_COMPAT_LARGE_FILE = 0x0002
+    EXT2_FLAGS_UNSIGNED_HASH = 0x0002
+    # features which writing code knows how to keep consistent
+    writable_incompat = EXT2_FEATURE_INCOMPAT_FILETYPE
+    writable_ro_compat = (EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER |
+                          EXT2_FEATURE_RO_COMPAT_LARGE_FILE)
+    counters_offset = struct.calcsize('3I')    # s_free_blocks_count
+    wtime_offset = struct.calcsize('12I')
 
     def __init__(self, io):
         byte_array = io.read_at(self.sb_size, self.file_offset)
@@ -387,18 +1287,33 @@ class e2superblock:
         self.boot_block = self.d['s_first_data_block']
         self.name = str(self.d['s_volume_name']).strip('\0')
         self.uuid = str(uuid.UUID(bytes=self.d['s_uuid']))
+        self.hash_seed = struct.unpack('4I', self.d['s_hash_seed'])
 
         self.check()
 
     def check(self):
-        pass
+        """ refuse a geometry the parsers can't work with """
+        if self.d['s_log_block_size'] > 6:
+            raise Ext2Exception('Invalid block size: 1024 << %d'
+                                % self.d['s_log_block_size'])
+        for k in ('s_blocks_per_group', 's_inodes_per_group'):
+            if not 0 < self.d[k] <= 8 * self.blksz:
+                raise Ext2Exception('Invalid %s: %d' % (k, self.d[k]))
+        if self.boot_block >= self.n_blocks:
+            raise Ext2Exception('Invalid s_first_data_block: %d'
+                                % self.boot_block)
+        inosz = self.inode_size()
+        if inosz < 128 or inosz > self.blksz or inosz & (inosz - 1):
+            raise Ext2Exception('Invalid inode size: %d' % inosz)
 
     def __str__(self):
         res = ''
         for k in self.d:
             v = str(self.d[k])
-            if k == 's_uuid':
-                v = self.uuid
+            if k in ('s_uuid', 's_journal_uuid', 's_hash_seed'):
+                v = str(uuid.UUID(bytes=self.d[k]))
+            elif k == 's_jnl_blocks':
+                v = ' '.join('%x' % b for b in struct.unpack('17I', self.d[k]))
             elif k in ('s_lastcheck', 's_wtime'):
                 v = time_format(self.d[k])
             res += ('%s = %s\n' % (k, v))
@@ -407,18 +1322,229 @@ class e2superblock:
     def block_size(self):
         return self.blksz
 
+    def has_dir_index(self):
+        return bool(self.d['s_feature_compat'] &
+                    self.EXT2_FEATURE_COMPAT_DIR_INDEX)
+
+    def unsigned_hash(self):
+        return bool(self.d['s_flags'] & self.EXT2_FLAGS_UNSIGNED_HASH)
+
+    def has_super(self, group):
+        """ whether block group 'group' keeps a copy of the superblock
+        and the descriptors: with sparse_super only groups 0, 1 and
+        powers of 3, 5 and 7 do """
+        if group <= 1 or not self.d['s_feature_ro_compat'] & \
+                self.EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER:
+            return True
+        for base in (3, 5, 7):
+            n = base
+            while n < group:
+                n *= base
+            if n == group:
+                return True
+        return False
+
+    def has_filetype(self):
+        return bool(self.d['s_feature_incompat'] &
+                    self.EXT2_FEATURE_INCOMPAT_FILETYPE)
+
+    def check_writable(self):
+        incompat = self.d['s_feature_incompat'] & ~self.writable_incompat
+        ro_compat = self.d['s_feature_ro_compat'] & ~self.writable_ro_compat
+        if incompat or ro_compat:
+            raise Ext2Exception('Cannot write: unsupported features '
+                                'incompat=0x%x, ro_compat=0x%x'
+                                % (incompat, ro_compat))
+
+    def write_counters(self, io):
+        """ write the free blocks/inodes counters and the write time """
+        self.d['s_free_blocks_count'] = self.n_free_blocks
+        self.d['s_free_inodes_count'] = self.n_free_inodes
+        self.d['s_wtime'] = int(time.time())
+        io.write_at(struct.pack('2I', self.n_free_blocks, self.n_free_inodes),
+                    self.file_offset + self.counters_offset)
+        io.write_at(struct.pack('I', self.d['s_wtime']),
+                    self.file_offset + self.wtime_offset)
+
     def inode_size(self):
         if self.d['s_rev_level'] > 0:
             return self.d['s_inode_size']
         return 128
 
 
+class e2index:
+    """ a sidecar file with the metadata of an image in SQLite: the
+    entries of every directory and the records and block maps of all
+    used inodes, so a mount can answer lookups and stats without
+    reading the image. It describes one state of the image: the UUID,
+    s_wtime and s_mnt_count of the superblock are stored in it, opening
+    it for a different state raises Ext2Exception.
+    SQLite maps the file into memory (up to mmap_size bytes) and reads
+    only the pages which queries touch.
+    """
+    version = 1
+    mmap_size = 1 << 30
+    insert_batch = 4096
+
+    def __init__(self, path, sb):
+        if not os.path.exists(path):
+            raise Ext2Exception('No index file %s' % path)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._lock = T.Lock()
+        try:
+            self._db.execute('PRAGMA mmap_size = %d' % self.mmap_size)
+            stamp = dict(self._db.execute('SELECT key, value FROM meta'))
+        except sqlite3.DatabaseError as e:
+            self._db.close()
+            raise Ext2Exception('Bad index file %s: %s' % (path, e))
+        if stamp != self.stamp(sb):
+            self._db.close()
+            raise Ext2Exception('Index %s is for another state of the '
+                                'image' % path)
+
+    @classmethod
+    def stamp(cls, sb):
+        return {'version': str(cls.version), 'uuid': sb.uuid,
+                'wtime': str(sb.d['s_wtime']),
+                'mnt_count': str(sb.d['s_mnt_count'])}
+
+    def close(self):
+        self._db.close()
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    @staticmethod
+    def _dentry(ino_num, name, filetype):
+        size = e2dentry.rec_len(len(name))
+        return e2dentry(e2dentry.d_struct.pack(ino_num, size, len(name),
+                                               filetype) +
+                        name.ljust(size - e2dentry.fmt_size, '\0'))
+
+    def lookup(self, dir_ino, name):
+        """ e2dentry for 'name' in directory #dir_ino or None """
+        rows = self._query('SELECT ino, ftype FROM dentries '
+                           'WHERE dir = ? AND name = ?',
+                           (dir_ino, buffer(name)))
+        if not rows:
+            return None
+        return self._dentry(rows[0][0], name, rows[0][1])
+
+    def entries(self, dir_ino):
+        """ list of e2dentry of directory #dir_ino, in disk order, or
+        None if it is not a directory of the index """
+        rows = self._query('SELECT name, ino, ftype FROM dentries '
+                           'WHERE dir = ? ORDER BY pos', (dir_ino,))
+        return [self._dentry(ino, str(name), ftype)
+                for (name, ino, ftype) in rows] or None
+
+    def inodes(self, ino_nums, io, inosz):
+        """ {inode number: e2inode} for those of 'ino_nums' which are
+        in the index, with their block maps """
+        res = {}
+        ino_nums = list(ino_nums)
+        for i in xrange(0, len(ino_nums), 512):
+            chunk = ino_nums[i:i + 512]
+            rows = self._query('SELECT ino, record, extents FROM inodes '
+                               'WHERE ino IN (%s)'
+                               % ','.join('?' * len(chunk)), chunk)
+            for ino_num, record, extents in rows:
+                inode = e2inode(ino_num, io, 0, inosz, str(record))
+                inode._extents = array.array('I')
+                inode._extents.fromstring(str(extents))
+                res[ino_num] = inode
+        return res
+
+    @classmethod
+    def build(cls, fs, path):
+        """ write the index of file system 'fs' to 'path'. It is built
+        in a temporary file which replaces 'path' when complete. """
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        db = sqlite3.connect(tmp)
+        try:
+            db.execute('PRAGMA journal_mode = OFF')
+            db.execute('PRAGMA synchronous = OFF')
+            db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            db.execute('CREATE TABLE dentries (dir INTEGER, pos INTEGER, '
+                       'name BLOB, ino INTEGER, ftype INTEGER, '
+                       'PRIMARY KEY (dir, name)) WITHOUT ROWID')
+            db.execute('CREATE TABLE inodes (ino INTEGER PRIMARY KEY, '
+                       'record BLOB, extents BLOB)')
+            inodes, dentries = [], []
+            for inode in fs.iter_inodes(extents=True):
+                inodes.append((inode.index,
+                               buffer(e2inode.i_struct.pack(*inode._raw)),
+                               buffer(inode.extents().tostring())))
+                if inode.is_directory() and inode.nlink:
+                    for pos, e in enumerate(e2directory(fs.io, inode, fs.sb)):
+                        dentries.append((inode.index, pos, buffer(e.name),
+                                         e.inode, e.filetype))
+                if len(inodes) >= cls.insert_batch or \
+                        len(dentries) >= cls.insert_batch:
+                    db.executemany('INSERT INTO inodes VALUES (?, ?, ?)',
+                                   inodes)
+                    db.executemany('INSERT OR REPLACE INTO dentries '
+                                   'VALUES (?, ?, ?, ?, ?)', dentries)
+                    inodes, dentries = [], []
+            db.executemany('INSERT INTO inodes VALUES (?, ?, ?)', inodes)
+            db.executemany('INSERT OR REPLACE INTO dentries '
+                           'VALUES (?, ?, ?, ?, ?)', dentries)
+            db.executemany('INSERT INTO meta VALUES (?, ?)',
+                           cls.stamp(fs.sb).items())
+            db.commit()
+        except:
+            db.close()
+            os.remove(tmp)
+            raise
+        db.close()
+        os.rename(tmp, path)
+
+
 class ext2fs:
     """ an ext2fs object represents a mounted ext2 file system.
+    'cache_bytes' is the size of the block cache, use_mmap=True maps
+    the image into memory instead, see E2IO. Up to 'inode_cache_size'
+    parsed inodes and 'dentry_cache_size' name lookups (including failed
+    ones) are kept in memory.
+    With writable=True files can be added with push(); bitmaps and
+    counters are written back by flush() and umount().
+    'index' is the path of an e2index made by build_index() for this
+    state of the image: directories and inodes are then read from it.
+    A read-only mount ignores an index which does not match the image
+    (see index_error), a writable one does not use it.
     """
-    def __init__(self, filename):
-        self.io = E2IO(filename)
+    pull_chunk = 1024 * 1024
+    walk_batch = 1024
+    _copy_method = _copy_methods[0]
+
+    def __init__(self, filename, cache_bytes=E2IO.default_cache_bytes,
+                 use_mmap=False, inode_cache_size=4096,
+                 dentry_cache_size=16384, writable=False, index=None):
+        self.filename = filename
+        self.io = E2IO(filename, cache_bytes, use_mmap, writable)
         self.sb = e2superblock(self.io)
+        if writable:
+            self.sb.check_writable()
+        self.index = None
+        self.index_error = None
+        if index is not None and not writable:
+            try:
+                self.index = e2index(index, self.sb)
+            except Ext2Exception as e:
+                self.index_error = str(e)
+        # ('b' or 'i', group) -> bytearray of a loaded bitmap:
+        self._bitmaps = {}
+        self._dirty = set()
+        # directory inode -> block to look for free room in first:
+        self._dir_hint = {}
+        self._icache = e2lru(inode_cache_size)
+        # (dir inode, dir generation, name) -> e2dentry or None:
+        self._dcache = e2lru(dentry_cache_size)
+        self._dgen = {}
 
         self._blksz = self.sb.block_size()
         self._indsz = self.sb.inode_size()
@@ -427,65 +1553,198 @@ class ext2fs:
         self.root = self._inode(self.sb.root_dir_inode)
 
     def umount(self):
+        if self.io.writable:
+            self.flush()
+        if self.index is not None:
+            self.index.close()
         self.io.close()
 
+    def build_index(self, path):
+        """ write an e2index of the image to 'path', see e2index """
+        e2index.build(self, path)
+
     def _blkgrps_read(self):
         self._n_blkgrps = self.sb.n_blocks / self.sb.blocks_in_grp
         if self.sb.n_blocks % self.sb.blocks_in_grp:
             self._n_blkgrps += 1
 
         offset = (1 + self.sb.boot_block) * self._blksz
-        bgd = []
-        for i in range(self._n_blkgrps):
-            bgd.append(e2group_descriptor(self, offset, i))
-        return bgd
+        return e2group_table(self, offset, self._n_blkgrps)
 
     def _inode(self, ino_num):
-        """ construct and read e2inode for index #ino_num"""
+        """ return e2inode for index #ino_num, from the inode cache
+        or read from the inode table """
+        inode = self._icache.get(ino_num)
+        if inode is None:
+            if self.index is not None:
+                inode = self.index.inodes([ino_num], self.io,
+                                          self._indsz).get(ino_num)
+            if inode is None:
+                offset = self._inode_offset(ino_num)
+                inode = e2inode(ino_num, self.io, offset, self._indsz)
+            self._icache.put(ino_num, inode)
+        return inode
+
+    def _inode_offset(self, ino_num):
+        """ image offset of the record of inode #ino_num """
+        if not 0 < ino_num <= self.sb.n_inodes:
+            raise Ext2Exception('Invalid inode number %d' % ino_num)
         group_index = (ino_num - 1) % self.sb.inodes_in_grp
         bg = self._bgd[(ino_num - 1) / self.sb.inodes_in_grp]
         offset = bg.inode_table * self._blksz   # go to inode table
-        offset += group_index * self._indsz
-        return e2inode(ino_num, self.io, offset, self._indsz)
-
-    def _ent_by_path(self, pathto):
-        if pathto == '/':
-            return e2directory(self.io, self.root).ent_by_name('.')
-
-        path_array = pathto.split('/')
-        while path_array.count(''):
-            path_array.remove('')
+        return offset + group_index * self._indsz
+
+    def load_inodes(self, ino_nums):
+        """ read many inodes at once, return {inode number: e2inode}.
+        Inodes are read in inode number order, every inode table block
+        only once, and go to the inode cache. """
+        inodes = {}
+        table_block = buf = None
+        ino_nums = sorted(set(ino_nums))
+        if self.index is not None:
+            for ino_num, inode in self.index.inodes(
+                    [n for n in ino_nums if n not in self._icache],
+                    self.io, self._indsz).iteritems():
+                self._icache.put(ino_num, inode)
+        for ino_num in ino_nums:
+            inode = self._icache.get(ino_num)
+            if inode is None:
+                block, offset = divmod(self._inode_offset(ino_num),
+                                       self._blksz)
+                if block != table_block:
+                    table_block = block
+                    buf = self.io.read_block(block)
+                inode = e2inode(ino_num, self.io, offset, self._indsz, buf)
+                self._icache.put(ino_num, inode)
+            inodes[ino_num] = inode
+        return inodes
+
+    def iter_inodes(self, groups=None, extents=False, processes=0):
+        """ yield e2inode of every used inode (the reserved ones included)
+        of block groups 'groups' (all by default), in inode number order.
+        Inode tables are read sequentially in chunks of up to pull_chunk
+        bytes; only inodes marked in the inode bitmaps are parsed, chunks
+        without them are skipped. Block maps are not built unless
+        'extents' is true, then e2inode.extents() is ready for each inode.
+        With 'processes' > 0 the groups are scanned by a pool of that many
+        processes, which read the image as it is on disk. The inodes do
+        not go to the inode cache.
+        """
+        if groups is None:
+            groups = xrange(self._n_blkgrps)
+        groups = list(groups)
+        if processes <= 0:
+            self.load_bitmaps(groups)
+            for g in groups:
+                for inode in self._group_inodes(g, extents):
+                    yield inode
+            return
+
+        if self.io.writable:
+            self.flush()
+        pool = multiprocessing.Pool(processes, _scan_init,
+                                    (self.filename, self.io.map is not None))
+        try:
+            for records in pool.imap(_scan_group,
+                                     [(g, extents) for g in groups]):
+                for ino_num, record, ext in records:
+                    inode = e2inode(ino_num, self.io, 0, self._indsz, record)
+                    inode._extents = ext
+                    yield inode
+            pool.close()
+        finally:
+            pool.terminate()
+
+    def _group_inodes(self, group, extents=False):
+        """ yield e2inode of the used inodes of 'group', see iter_inodes """
+        n = self.sb.inodes_in_grp
+        bm = self._bitmap('i', group)
+        per_chunk = max(1, self.pull_chunk / self._indsz)
+        table = self._bgd[group].inode_table * self._blksz
+        i = bit_find(bm, 1, 0, n)
+        while i < n:
+            start = i
+            end = min(n, start + per_chunk)
+            buf = self.io.read_extent((end - start) * self._indsz,
+                                      table + start * self._indsz)
+            while i < end:
+                inode = e2inode(group * n + i + 1, self.io,
+                                (i - start) * self._indsz, self._indsz, buf)
+                if extents:
+                    inode.extents()
+                yield inode
+                i = bit_find(bm, 1, i + 1, end)
+            i = bit_find(bm, 1, end, n)
+
+    def _lookup(self, dir_inode, name):
+        """ return e2dentry for 'name' in directory 'dir_inode' or None,
+        answers (negative ones too) are kept in the dentry cache """
+        ino_num = dir_inode.index
+        key = (ino_num, self._dgen.get(ino_num, 0), name)
+        dentry = self._dcache.get(key, _missing)
+        if dentry is _missing:
+            if self.index is not None:
+                dentry = self.index.lookup(ino_num, name)
+            else:
+                d = e2directory(self.io, dir_inode, self.sb)
+                dentry = d.ent_by_name(name)
+            self._dcache.put(key, dentry)
+        return dentry
 
+    def _prime_dcache(self, dir_ino, entries):
+        """ remember the entries of directory #dir_ino, already read
+        by the caller, as the results of lookups """
+        gen = self._dgen.get(dir_ino, 0)
+        for e in entries:
+            self._dcache.put((dir_ino, gen, e.name), e)
+
+    def stats(self):
+        """ I/O counters and cache statistics, see E2IO.stats() """
+        return {'io': self.io.stats(),
+                'inode_cache': self._icache.stats(),
+                'dentry_cache': self._dcache.stats()}
+
+    def invalidate_dir(self, ino_num):
+        """ forget cached lookups in directory #ino_num """
+        self._dgen[ino_num] = self._dgen.get(ino_num, 0) + 1
+
+    def _walk(self, pathto):
+        """ return (e2dentry, e2inode) for path 'pathto' """
         inode = self.root
         dentry = None
-        for fname in path_array:
-            dentry = e2directory(self.io, inode).ent_by_name(fname)
+        for fname in pathto.split('/'):
+            if not fname:
+                continue
+            dentry = self._lookup(inode, fname)
             if dentry is None:
                 raise Ext2Exception(
                     'Name lookup failed for "%s" in "%s"' % (fname, pathto))
             inode = self._inode(dentry.inode)
+        return dentry, inode
+
+    def _ent_by_path(self, pathto):
+        dentry = self._walk(pathto)[0]
+        if dentry is None:
+            return self._lookup(self.root, '.')
         return dentry
 
     def _inode_by_path(self, pathto):
         """ return e2inode for path 'pathto' """
         if pathto == '/':
             return self.root
-
-        path_array = pathto.split('/')
-        while path_array.count(''):
-            path_array.remove('')
-
-        inode = self.root
-        for fname in path_array:
-            dentry = e2directory(self.io, inode).ent_by_name(fname)
-            if dentry is None:
-                raise Ext2Exception(
-                    'Name lookup failed for "%s" in "%s"' % (fname, pathto))
-            inode = self._inode(dentry.inode)
-        return inode
+        return self._walk(pathto)[1]
 
     def _dir_by_inode(self, ino_num):
-        return e2directory(self.io, self._inode(ino_num))
+        return e2directory(self.io, self._inode(ino_num), self.sb)
+
+    def dir_entries(self, ino_num):
+        """ list of e2dentry of directory #ino_num, from the index if
+        there is one """
+        if self.index is not None:
+            entries = self.index.entries(ino_num)
+            if entries is not None:
+                return entries
+        return self._dir_by_inode(ino_num).ent
 
     def free_space_bytes(self):
         return self.sb.n_free_blocks * self._blksz
@@ -493,6 +1752,116 @@ class ext2fs:
     def space_bytes(self):
         return self.sb.n_blocks * self._blksz
 
+    def load_bitmaps(self, groups=None):
+        """ read the block and inode bitmaps of 'groups' (all groups by
+        default) which are not loaded yet. Bitmap blocks which are next
+        to each other on disk (the two bitmaps of a group, all of them
+        with flex_bg) are read together, up to pull_chunk bytes at once. """
+        if groups is None:
+            groups = xrange(self._n_blkgrps)
+        wanted = []
+        for g in groups:
+            bg = self._bgd[g]
+            for kind, block in (('b', bg.block_bitmap),
+                                ('i', bg.inode_bitmap)):
+                if (kind, g) not in self._bitmaps:
+                    wanted.append((block, kind, g))
+        wanted.sort()
+        blksz = self._blksz
+        per_read = max(1, self.pull_chunk / blksz)
+        i = 0
+        while i < len(wanted):
+            n = 1
+            while i + n < len(wanted) and n < per_read and \
+                    wanted[i + n][0] == wanted[i][0] + n:
+                n += 1
+            buf = str(self.io.read_extent(n * blksz, wanted[i][0] * blksz))
+            for j in xrange(n):
+                block, kind, g = wanted[i + j]
+                self._bitmaps[(kind, g)] = \
+                    bytearray(buf[j * blksz:(j + 1) * blksz])
+            i += n
+
+    def free_runs(self, group=None):
+        """ yield (first block, length) of free block runs of 'group' or
+        of all groups, in disk order """
+        groups = xrange(self._n_blkgrps) if group is None else [group]
+        for g in groups:
+            first, size = self._group_blocks(g)
+            for start, length in bitmap_runs(self._bitmap('b', g), 0, size):
+                yield first + start, length
+
+    def space_report(self):
+        """ free space by block group, as counted in the bitmaps.
+        Returns a dict with 'groups' (a list of dicts), the totals for the
+        whole file system and 'mismatches': messages about descriptor and
+        superblock counters which disagree with the bitmaps.
+        For every group and the total there are 'free_blocks',
+        'free_inodes', 'free_runs' (number of runs of free blocks),
+        'largest_free' (the longest run) and 'fragmentation': 0.0 when
+        the free blocks of every group are in one run, close to 1.0 when
+        they are scattered (1 - sum(run length ** 2) / sum(free_blocks **
+        2), free_blocks taken per group: a run can not be longer than the
+        group, so a freshly made file system scores 0). 'histogram' maps
+        run lengths rounded down to a power of two to [runs, blocks].
+        Runs are counted within groups, they are never merged across a
+        group boundary.
+        """
+        def fragmentation(squares, ideal):
+            return 1.0 - float(squares) / ideal if ideal else 0.0
+
+        self.load_bitmaps()
+        groups, mismatches = [], []
+        histogram = {}
+        total = {'free_blocks': 0, 'free_inodes': 0, 'free_runs': 0,
+                 'largest_free': 0}
+        squares = ideal = 0
+        for g, bg in enumerate(self._bgd):
+            size = self._group_blocks(g)[1]
+            free_blocks = size - bit_count(self._bitmap('b', g), 0, size)
+            free_inodes = self.sb.inodes_in_grp - \
+                bit_count(self._bitmap('i', g), 0, self.sb.inodes_in_grp)
+            runs = [length for (start, length) in
+                    bitmap_runs(self._bitmap('b', g), 0, size)]
+            group_squares = sum(length * length for length in runs)
+            for length in runs:
+                bucket = histogram.setdefault(
+                    1 << (length.bit_length() - 1), [0, 0])
+                bucket[0] += 1
+                bucket[1] += length
+            st = {'group': g, 'free_blocks': free_blocks,
+                  'free_inodes': free_inodes, 'free_runs': len(runs),
+                  'largest_free': max(runs) if runs else 0,
+                  'fragmentation': fragmentation(group_squares,
+                                                 free_blocks ** 2)}
+            groups.append(st)
+            for k in ('free_blocks', 'free_inodes', 'free_runs'):
+                total[k] += st[k]
+            total['largest_free'] = max(total['largest_free'],
+                                        st['largest_free'])
+            squares += group_squares
+            ideal += free_blocks ** 2
+
+            if bg.free_blocks != free_blocks:
+                mismatches.append('group %d: %d free blocks in the '
+                                  'descriptor, %d in the bitmap'
+                                  % (g, bg.free_blocks, free_blocks))
+            if bg.free_inodes != free_inodes:
+                mismatches.append('group %d: %d free inodes in the '
+                                  'descriptor, %d in the bitmap'
+                                  % (g, bg.free_inodes, free_inodes))
+
+        if self.sb.n_free_blocks != total['free_blocks']:
+            mismatches.append('superblock: %d free blocks, %d in the bitmaps'
+                              % (self.sb.n_free_blocks, total['free_blocks']))
+        if self.sb.n_free_inodes != total['free_inodes']:
+            mismatches.append('superblock: %d free inodes, %d in the bitmaps'
+                              % (self.sb.n_free_inodes, total['free_inodes']))
+        total['fragmentation'] = fragmentation(squares, ideal)
+        total.update(groups=groups, histogram=histogram,
+                     mismatches=mismatches)
+        return total
+
     def ls(self, pathname, opts=''):
         """list files in 'pathname' like 'ls -l'
         The second argument controls listing format, options:
@@ -506,14 +1875,97 @@ class ext2fs:
 
         inode = self._inode_by_path(pathname)
         if inode.is_directory():
-            d = e2directory(self.io, inode)
+            d = e2directory(self.io, inode, self.sb)
             for e in d.ent:
                 print_dentry(e)
         else:
             print inode
 
-    def pull(self, fspath, to_file):
-        """copy file from ext2 image at 'fspath' to external file 'to_file' """
+    def walk(self, top='/'):
+        """ yield (path, e2inode) for 'top' and everything below it.
+        Directories are read breadth first; the names of several of them
+        (at least walk_batch, if there are that many) are collected and
+        their inodes loaded at once in inode number order, so inode table
+        blocks are read in order and only once per batch. """
+        inode = self._inode_by_path(top)
+        top = '/' + top.strip('/')
+        yield top, inode
+        dirs = collections.deque()
+        if inode.is_directory():
+            dirs.append((top.rstrip('/'), inode))
+        batch = []
+        while dirs or batch:
+            if dirs and len(batch) < self.walk_batch:
+                path, d = dirs.popleft()
+                batch.extend((path + '/' + e.name, e.inode)
+                             for e in self.dir_entries(d.index)
+                             if e.name not in ('.', '..'))
+                continue
+            inodes = self.load_inodes(ino for (path, ino) in batch)
+            for path, ino in batch:
+                child = inodes[ino]
+                yield path, child
+                if child.is_directory():
+                    dirs.append((path, child))
+            batch = []
+
+    def find(self, top='/', name=None, filetype=None, min_size=None,
+             max_size=None, newer=None, older=None, predicate=None):
+        """ yield (path, e2inode) of files below 'top' (and 'top' itself)
+        which match all given conditions: 'name' is a shell pattern for
+        the last path component, 'filetype' is a letter as in ls ('-', 'd',
+        'l', ...), sizes are in bytes, 'newer'/'older' limit the mtime,
+        'predicate' is called as predicate(path, inode). """
+        for path, inode in self.walk(top):
+            if name is not None and \
+                    not fnmatch.fnmatchcase(path.rsplit('/', 1)[-1], name):
+                continue
+            if filetype is not None and \
+                    stat_filetype.get(stat.S_IFMT(inode.mode)) != filetype:
+                continue
+            if min_size is not None and inode.n_length < min_size:
+                continue
+            if max_size is not None and inode.n_length > max_size:
+                continue
+            if newer is not None and inode.mtime <= newer:
+                continue
+            if older is not None and inode.mtime >= older:
+                continue
+            if predicate is not None and not predicate(path, inode):
+                continue
+            yield path, inode
+
+    def du(self, top='/'):
+        """ disk usage (from i_blocks) of 'top' and of every directory
+        below it, everything inside included: {path: bytes}. Files with
+        several links are counted once. """
+        usage = {}
+        dirs = []
+        seen = set()
+        for path, inode in self.walk(top):
+            n = inode.blocks * 512
+            if inode.nlink > 1 and not inode.is_directory():
+                if inode.index in seen:
+                    n = 0
+                seen.add(inode.index)
+            if inode.is_directory() or not dirs:
+                usage[path] = n
+                dirs.append(path)
+            else:
+                usage[os.path.dirname(path)] += n
+        # breadth first: children go after their parents
+        for path in reversed(dirs[1:]):
+            usage[os.path.dirname(path)] += usage[path]
+        return usage
+
+    def pull(self, fspath, to_file, progress=None):
+        """copy file from ext2 image at 'fspath' to external file 'to_file'.
+        Data is moved extent by extent, by the kernel where possible
+        (copy_file_range, sendfile), holes are skipped so the copy of
+        a sparse file is sparse too. 'progress' is called with the number
+        of bytes after every copied piece.
+        Returns (bytes copied, seconds spent).
+        """
         inode = self._inode_by_path(fspath)
         try:
             st = os.stat(to_file)
@@ -522,67 +1974,850 @@ class ext2fs:
         except OSError:
             pass
 
-        bytes_written = 0
-        destination = open(to_file, 'wb')
-        for block in inode.get_block_list():
-            bytes_to_copy = min(inode.n_length - bytes_written, self._blksz)
-            if bytes_to_copy <= 0:
-                destination.close()
-                os.remove(to_file)
-                raise Ext2Exception('Redundant blocks in file %s' % fspath)
-            piece = self.io.read_block(block)[:bytes_to_copy]
-            destination.write(piece)
-            bytes_written += bytes_to_copy
-        destination.close()
-
-    def read(self, fspath, offset, bytes_count):
-        if bytes_count <= 0 or offset < 0:
-            return ''
-
-        inode = self._inode_by_path(fspath)
-
-        end_offset = offset + bytes_count
-        if end_offset > inode.n_length:
-            end_offset = inode.n_length
-            bytes_count = inode.n_length - offset
-
-        start_fileblock = offset / self._blksz
-        end_fileblock = end_offset / self._blksz
+        started = time.time()
+        copied = self._pull_inode(inode, to_file, progress)
+        return copied, time.time() - started
 
-        start_block_offset = offset % self._blksz
-        start_block = inode.block_at(start_fileblock)
-        contents = self.io.read_block(start_block)[start_block_offset:]
-        if start_block_offset + bytes_count <= self._blksz:
-            return contents[:bytes_count]
+    def _pull_inode(self, inode, to_file, progress=None):
+        fd = os.open(to_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            copied = self._copy_data(inode, fd, progress)
+            os.ftruncate(fd, inode.n_length)
+        finally:
+            os.close(fd)
+        return copied
+
+    def pull_tree(self, fspath, to_dir, workers=4, progress=None):
+        """copy directory 'fspath' with everything below it from the image
+        to external directory 'to_dir'. Directories, regular files,
+        symlinks and fifos are recreated with their permissions and
+        timestamps (and owners, when run as root); device nodes and
+        sockets are skipped.
+        Files are copied by 'workers' threads in the order of their first
+        block on disk, so the image is read mostly front to back.
+        'progress' is called from the workers as
+        progress(files done, files total, bytes done, bytes total).
+        Returns a dict of totals.
+        """
+        started = time.time()
+        top = self._inode_by_path(fspath)
+        if not top.is_directory():
+            raise Ext2Exception('Not a directory: %s' % fspath)
+
+        totals = {'dirs': 0, 'files': 0, 'links': 0, 'skipped': 0,
+                  'bytes': 0}
+        dirs = []
+        files = []
+        queue = collections.deque([(top, to_dir)])
+        while queue:
+            inode, dest = queue.popleft()
+            if not os.path.isdir(dest):
+                os.makedirs(dest)
+            dirs.append((inode.index, dest))
+            for e in e2directory(self.io, inode, self.sb):
+                if e.name in ('.', '..'):
+                    continue
+                child = self._inode(e.inode)
+                path = os.path.join(dest, e.name)
+                if child.is_directory():
+                    queue.append((child, path))
+                elif stat.S_ISREG(child.mode):
+                    files.append((child.block[0], child.index, path))
+                    totals['bytes'] += child.n_length
+                elif child.is_link() or stat.S_ISFIFO(child.mode):
+                    if os.path.lexists(path):
+                        os.remove(path)
+                    if child.is_link():
+                        os.symlink(self.readlink(child), path)
+                    else:
+                        os.mkfifo(path)
+                    self._copy_attrs(child, path)
+                    totals['links'] += child.is_link()
+                else:
+                    totals['skipped'] += 1
+        totals['dirs'] = len(dirs)
+        totals['files'] = len(files)
+        files.sort()
+
+        lock = T.Lock()
+        jobs = iter(files)
+        done = [0, 0]
+        errors = []
+
+        def count_bytes(n):
+            with lock:
+                done[1] += n
+                if progress is not None:
+                    progress(done[0], len(files), done[1], totals['bytes'])
+
+        def worker():
+            while not errors:
+                with lock:
+                    job = next(jobs, None)
+                if job is None:
+                    return
+                inode = self._inode(job[1])
+                copied = 0
+                try:
+                    copied = self._pull_inode(inode, job[2], count_bytes)
+                    self._copy_attrs(inode, job[2])
+                except (Ext2Exception, EnvironmentError) as e:
+                    errors.append((job[2], e))
+                with lock:
+                    done[0] += 1
+                    done[1] += inode.n_length - copied     # holes
+                    if progress is not None:
+                        progress(done[0], len(files), done[1],
+                                 totals['bytes'])
+
+        threads = [T.Thread(target=worker) for i in range(max(1, workers))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise Ext2Exception('Failed to copy %s: %s' % errors[0])
+
+        # files created in directories change their mtime, so directory
+        # attributes go last, the deepest directories first
+        for ino_num, dest in reversed(dirs):
+            self._copy_attrs(self._inode(ino_num), dest)
+        totals['seconds'] = time.time() - started
+        return totals
+
+    def _copy_attrs(self, inode, path):
+        if hasattr(os, 'lchown') and os.geteuid() == 0:
+            os.lchown(path, inode.uid, inode.gid)
+        if not inode.is_link():
+            os.chmod(path, stat.S_IMODE(inode.mode))
+            os.utime(path, (inode.atime, inode.mtime))
+
+    def _copy_data(self, inode, fd, progress=None):
+        """ copy the data regions of 'inode' to the same offsets of file
+        descriptor 'fd', return the number of bytes copied """
+        copied = 0
+        for start, length in self.data_map(inode):
+            for image_offset, count in self._pieces(inode, start, length):
+                self._copy_piece(fd, start, image_offset, count)
+                start += count
+                copied += count
+                if progress is not None:
+                    progress(count)
+        return copied
+
+    def _copy_piece(self, fd, file_offset, image_offset, count):
+        while count > 0:
+            n = 0
+            method = self._copy_method
+            try:
+                if method == 'copy_file_range':
+                    n = _kernel_copy[method](self.io.fd, fd, count,
+                                             image_offset, file_offset)
+                elif method == 'sendfile':
+                    os.lseek(fd, file_offset, os.SEEK_SET)
+                    n = _kernel_copy[method](fd, self.io.fd, image_offset,
+                                             count)
+                else:
+                    chunk = self.io.read_extent(min(count, self.pull_chunk),
+                                                image_offset)
+                    os.lseek(fd, file_offset, os.SEEK_SET)
+                    n = os.write(fd, chunk)
+            except OSError as e:
+                if method == 'buffered' or e.errno not in _no_kernel_copy:
+                    raise
+                # not supported for this pair of files: use the next method
+                self._copy_method = _copy_methods[
+                    _copy_methods.index(method) + 1]
+                continue
+            if n <= 0:
+                raise Ext2Exception('Unexpected end of image at offset %d'
+                                    % image_offset)
+            count -= n
+            image_offset += n
+            file_offset += n
+
+    def _as_inode(self, path_or_inode):
+        if isinstance(path_or_inode, e2inode):
+            return path_or_inode
+        return self._inode_by_path(path_or_inode)
+
+    def _pieces(self, inode, offset, count):
+        """ yield (image offset, length) of physically contiguous pieces
+        of bytes [offset, offset + count) of 'inode'; holes have image
+        offset None """
+        first = offset / self._blksz
+        last = (offset + count - 1) / self._blksz
+        for log, phys, n in inode.runs(first, last - first + 1):
+            start = max(offset, log * self._blksz)
+            end = min(offset + count, (log + n) * self._blksz)
+            if not phys:
+                yield None, end - start
+                continue
+            yield phys * self._blksz + start - log * self._blksz, end - start
+
+    def data_map(self, path_or_inode):
+        """ list of (offset, length) of the regions of a file which are
+        stored on disk, in file order; the rest of the file is holes which
+        read as zeros """
+        inode = self._as_inode(path_or_inode)
+        ext = inode.extents()
+        regions = []
+        for i in xrange(0, len(ext), 3):
+            start = ext[i] * self._blksz
+            end = min((ext[i] + ext[i + 2]) * self._blksz, inode.n_length)
+            if regions and sum(regions[-1]) == start:
+                regions[-1] = (regions[-1][0], end - regions[-1][0])
+            else:
+                regions.append((start, end - start))
+        return regions
+
+    def seek_data(self, path_or_inode, offset):
+        """ like lseek(SEEK_DATA): the first offset >= 'offset' which is
+        not in a hole, None if there is no data after 'offset' """
+        for start, length in self.data_map(path_or_inode):
+            if start + length > offset:
+                return max(start, offset)
+        return None
 
-        for i in range(start_fileblock + 1, end_fileblock):
-            contents += self.io.read_block(inode.block_at(i))
+    def seek_hole(self, path_or_inode, offset):
+        """ like lseek(SEEK_HOLE): the first offset >= 'offset' which is
+        in a hole or at the end of the file, None past the end of file """
+        inode = self._as_inode(path_or_inode)
+        if offset >= inode.n_length:
+            return None
+        for start, length in self.data_map(inode):
+            if start <= offset < start + length:
+                return start + length
+        return offset
+
+    def _clip(self, inode, offset, count):
+        """ number of bytes from 'offset' which are within the file """
+        if count <= 0 or offset < 0:
+            return 0
+        return max(0, min(count, inode.n_length - offset))
 
-        end_block_bytes = end_offset % self._blksz
-        if end_block_bytes:
-            end_block = inode.block_at(end_fileblock)
-            contents += self.io.read_block(end_block)[:end_block_bytes]
+    def read(self, fspath, offset, bytes_count):
+        """ read 'bytes_count' bytes at 'offset' from a file, given by its
+        path or e2inode. Physically contiguous blocks are fetched with
+        one read. """
+        inode = self._as_inode(fspath)
+        bytes_count = self._clip(inode, offset, bytes_count)
+        if not bytes_count:
+            return ''
 
-        return contents
+        pieces = []
+        for image_offset, length in self._pieces(inode, offset, bytes_count):
+            if image_offset is None:
+                pieces.append('\0' * length)
+            else:
+                pieces.append(self.io.read_extent(length, image_offset))
+        if len(pieces) == 1:
+            return str(pieces[0])
+        return ''.join(str(p) for p in pieces)
+
+    def readinto(self, path_or_inode, offset, buf):
+        """ fill 'buf' (a bytearray or a memoryview of one) with file
+        contents at 'offset', without intermediate strings; return the
+        number of bytes read """
+        inode = self._as_inode(path_or_inode)
+        count = self._clip(inode, offset, len(buf))
+        if not count:
+            return 0
+
+        done = 0
+        for image_offset, length in self._pieces(inode, offset, count):
+            if image_offset is None:
+                buf[done:done + length] = '\0' * length
+            else:
+                self.io.readinto_at(buf, image_offset, done, length)
+            done += length
+        return done
 
     def readlink(self, path):
-        inode = self._inode_by_path(path)
+        inode = self._as_inode(path)
         if inode.is_short_link():
             # in-place link, less than or equal to 60 characters
             return inode.blocks_as_string()
         # otherwise: long link with its own blocks
         s = ''
         for b in inode.get_block_list():
-            sb = self.io.read_block(b)
+            sb = str(self.io.read_block(b))
             s += sb.split('\0')[0]
             if sb.count('\0'):
                 break
         return s
 
     def push(self, from_file, to_fspath):
-        """ write an external file 'from_file' to ext2 path 'fspath' """
-        # TODO
-        pass
+        """copy external file or directory 'from_file' (with everything
+        below it) to ext2 path 'to_fspath', or into it if 'to_fspath' is
+        a directory. Existing directories are merged, other existing
+        names are an error. Files get contiguous runs of blocks near
+        their inode, data is written in large chunks in one pass.
+        Returns (bytes copied, seconds spent).
+        """
+        self._check_writable()
+        started = time.time()
+        from_file = os.path.expanduser(from_file)
+        name = os.path.basename(from_file.rstrip('/'))
+        try:
+            target = self._inode_by_path(to_fspath)
+        except Ext2Exception:
+            target = None
+        if target is None:
+            parent_path, name = os.path.split(to_fspath.rstrip('/'))
+            target = self._inode_by_path(parent_path or '/')
+        elif not target.is_directory():
+            raise Ext2Exception('File exists: %s' % to_fspath)
+        if not target.is_directory():
+            raise Ext2Exception('Not a directory: %s' % to_fspath)
+
+        copied = 0
+        fresh = set()   # directories made here: no names to look up
+        queue = collections.deque([(from_file, target.index, name)])
+        try:
+            while queue:
+                path, parent, name = queue.popleft()
+                st = os.lstat(path)
+                dentry = None
+                if parent not in fresh:
+                    dentry = self._lookup(self._inode(parent), name)
+                if dentry is not None and not (
+                        stat.S_ISDIR(st.st_mode) and
+                        self._inode(dentry.inode).is_directory()):
+                    raise Ext2Exception('File exists: %s' % name)
+                if dentry is None:
+                    # before anything is allocated for it
+                    self._check_name(name)
+
+                if dentry is not None:
+                    ino = dentry.inode
+                elif stat.S_ISDIR(st.st_mode):
+                    ino = self._push_dir(st, parent)
+                    fresh.add(ino)
+                elif stat.S_ISREG(st.st_mode):
+                    ino, n = self._push_file(path, st, parent)
+                    copied += n
+                elif stat.S_ISLNK(st.st_mode):
+                    ino = self._push_symlink(os.readlink(path), st, parent)
+                else:
+                    ino = self._push_special(st, parent)
+                if dentry is None:
+                    try:
+                        self._add_dentry(parent, name, ino, st.st_mode)
+                    except:
+                        self._free_inode(ino, parent)
+                        raise
+
+                if stat.S_ISDIR(st.st_mode):
+                    for child in sorted(os.listdir(path)):
+                        queue.append((os.path.join(path, child), ino, child))
+        finally:
+            self.flush()
+        return copied, time.time() - started
+
+    def _check_writable(self):
+        if not self.io.writable:
+            raise Ext2Exception('The file system is mounted read-only')
+
+    def _inode_group(self, ino_num):
+        return (ino_num - 1) / self.sb.inodes_in_grp
+
+    def _group_blocks(self, group):
+        """ (first block, number of blocks) of block group 'group' """
+        first = self.sb.boot_block + group * self.sb.blocks_in_grp
+        return first, min(self.sb.blocks_in_grp, self.sb.n_blocks - first)
+
+    def _bitmap(self, kind, group):
+        """ block ('b') or inode ('i') bitmap of 'group' as a bytearray,
+        loaded once and written back by flush() """
+        bm = self._bitmaps.get((kind, group))
+        if bm is None:
+            bg = self._bgd[group]
+            block = bg.block_bitmap if kind == 'b' else bg.inode_bitmap
+            bm = bytearray(str(self.io.read_block(block)))
+            self._bitmaps[(kind, group)] = bm
+        return bm
+
+    def flush(self):
+        """ write back the modified bitmaps, then the descriptors of
+        their groups (consecutive ones with one write) and the superblock
+        counters """
+        self._check_writable()
+        if not self._dirty:
+            return
+        groups = sorted(set(group for (kind, group) in self._dirty))
+        for kind, group in sorted(self._dirty):
+            bg = self._bgd[group]
+            block = bg.block_bitmap if kind == 'b' else bg.inode_bitmap
+            self.io.write_block(block, self._bitmaps[(kind, group)])
+        gd_size = e2group_descriptor.gd_size
+        while groups:
+            n = 1
+            while n < len(groups) and groups[n] == groups[0] + n:
+                n += 1
+            first = self._bgd[groups[0]]
+            buf = bytearray(str(self.io.read_at(n * gd_size, first.offset)))
+            for i in xrange(n):
+                buf[i * gd_size:i * gd_size + struct.calcsize(
+                    e2group_descriptor.gd_fmt)] = self._bgd[groups[i]].pack()
+            self.io.write_at(str(buf), first.offset)
+            groups = groups[n:]
+        self.sb.write_counters(self.io)
+        self._dirty.clear()
+        self.io.sync()
+
+    def _alloc_inode(self, parent, is_dir):
+        """ allocate an inode for a child of directory #parent, return
+        its number. Directories made in the root go to the group with
+        the most free blocks among those with at least the average number
+        of free inodes; everything else goes to the parent's group or
+        the next one with free inodes. """
+        n = self._n_blkgrps
+        goal = self._inode_group(parent)
+        groups = [g % n for g in xrange(goal, goal + n)]
+        if is_dir and parent == self.sb.root_dir_inode:
+            average = self.sb.n_free_inodes / n
+            candidates = [g for g in groups
+                          if self._bgd[g].free_inodes >= max(1, average)]
+            if candidates:
+                best = max(candidates, key=lambda g: self._bgd[g].free_blocks)
+                groups.insert(0, best)
+
+        for g in groups:
+            bg = self._bgd[g]
+            if not bg.free_inodes:
+                continue
+            bm = self._bitmap('i', g)
+            i = bit_find(bm, 0, 0, self.sb.inodes_in_grp)
+            if i >= self.sb.inodes_in_grp:
+                continue
+            set_bits(bm, i, 1)
+            bg.free_inodes -= 1
+            bg.used_dirs += is_dir
+            self.sb.n_free_inodes -= 1
+            self._dirty.add(('i', g))
+            return g * self.sb.inodes_in_grp + i + 1
+        raise Ext2Exception('No free inodes left')
+
+    def _release_inode(self, ino_num, is_dir):
+        group, i = divmod(ino_num - 1, self.sb.inodes_in_grp)
+        set_bits(self._bitmap('i', group), i, 1, 0)
+        self._bgd[group].free_inodes += 1
+        self._bgd[group].used_dirs -= is_dir
+        self.sb.n_free_inodes += 1
+        self._dirty.add(('i', group))
+
+    def _free_inode(self, ino_num, parent):
+        """ undo making inode #ino_num in directory #parent: release its
+        blocks and the inode """
+        inode = self._inode(ino_num)
+        runs = [(b, 1) for b in inode.indirect_blocks()]
+        ext = inode.extents()
+        runs.extend((ext[i + 1], ext[i + 2]) for i in xrange(0, len(ext), 3))
+        self._release_blocks(runs)
+        self._update_inode(ino_num, i_links_count=0,
+                           i_dtime=int(time.time()))
+        self._release_inode(ino_num, inode.is_directory())
+        if inode.is_directory():
+            self._update_inode(parent,
+                               i_links_count=self._inode(parent).nlink - 1)
+
+    def _alloc_blocks(self, count, goal_group):
+        """ allocate 'count' blocks, return a list of (first block,
+        length) runs. One free run which holds all blocks, in group
+        'goal_group' or the nearest group after it, is preferred;
+        otherwise the free runs are taken in disk order from the goal
+        group on. """
+        n = self._n_blkgrps
+        groups = [g % n for g in xrange(goal_group, goal_group + n)]
+        if count <= self.sb.blocks_in_grp:
+            for g in groups:
+                if self._bgd[g].free_blocks < count:
+                    continue
+                size = self._group_blocks(g)[1]
+                for start, length in bitmap_runs(self._bitmap('b', g),
+                                                 0, size):
+                    if length >= count:
+                        return [self._take_blocks(g, start, count)]
+
+        runs = []
+        for g in groups:
+            if not self._bgd[g].free_blocks:
+                continue
+            size = self._group_blocks(g)[1]
+            for start, length in list(bitmap_runs(self._bitmap('b', g),
+                                                  0, size)):
+                length = min(length, count)
+                runs.append(self._take_blocks(g, start, length))
+                count -= length
+                if not count:
+                    return runs
+        self._release_blocks(runs)
+        raise Ext2Exception('No space left for %d more blocks' % count)
+
+    def _take_blocks(self, group, start, count):
+        set_bits(self._bitmap('b', group), start, count)
+        self._bgd[group].free_blocks -= count
+        self.sb.n_free_blocks -= count
+        self._dirty.add(('b', group))
+        return self._group_blocks(group)[0] + start, count
+
+    def _release_blocks(self, runs):
+        for first, count in runs:
+            group, start = divmod(first - self.sb.boot_block,
+                                  self.sb.blocks_in_grp)
+            set_bits(self._bitmap('b', group), start, count, 0)
+            self._bgd[group].free_blocks += count
+            self.sb.n_free_blocks += count
+            self._dirty.add(('b', group))
+
+    def _n_indirect(self, n_blocks):
+        """ number of indirect blocks needed to map 'n_blocks' blocks """
+        per_block = self._blksz / struct.intsz
+
+        def tree(level, count):
+            if level == 0:
+                return 0
+            span = per_block ** (level - 1)
+            full, rest = divmod(count, span)
+            return (1 + full * tree(level - 1, span) +
+                    (tree(level - 1, rest) if rest else 0))
+
+        meta = 0
+        rest = n_blocks - e2inode.EXT2_NDIR_BLOCKS
+        for level in (1, 2, 3):
+            if rest <= 0:
+                break
+            span = per_block ** level
+            meta += tree(level, min(rest, span))
+            rest -= span
+        if rest > 0:
+            raise Ext2Exception('File is too large: %d blocks' % n_blocks)
+        return meta
+
+    def _write_file_blocks(self, f, size, goal_group):
+        """ allocate blocks for 'size' bytes near 'goal_group' and fill
+        them from file object 'f'. Indirect blocks precede the blocks
+        they map, as ext2 lays them out, so the data stays in long runs
+        which are written with large writes.
+        Returns (the 15 block pointers of the inode, blocks used). """
+        blksz = self._blksz
+        n = (size + blksz - 1) / blksz
+        block = [0] * e2inode.EXT2_N_BLOCKS
+        if not n:
+            return block, 0
+        used = n + self._n_indirect(n)
+        runs = self._alloc_blocks(used, goal_group)
+        try:
+            return self._fill_blocks(f, n, runs, block), used
+        except:
+            self._release_blocks(runs)
+            raise
+
+    def _fill_blocks(self, f, n, runs, block):
+        """ map 'n' blocks of file 'f' to the blocks of 'runs', write them
+        and the indirect blocks, return the inode's block pointers """
+        blksz = self._blksz
+        per_block = blksz / struct.intsz
+        free = (b for first, length in runs
+                for b in xrange(first, first + length))
+        run = [0, 0]    # data blocks assigned but not written yet
+
+        def write_run():
+            offset = run[0] * blksz
+            left = run[1] * blksz
+            while left:
+                count = min(left, self.pull_chunk)
+                chunk = f.read(count)
+                # the tail of the last block (or of a file which shrank)
+                chunk += '\0' * (count - len(chunk))
+                self.io.write_at(chunk, offset)
+                offset += count
+                left -= count
+            run[1] = 0
+
+        def data_block():
+            b = next(free)
+            if run[1] and b == run[0] + run[1]:
+                run[1] += 1
+            else:
+                if run[1]:
+                    write_run()
+                run[:] = [b, 1]
+            return b
+
+        def indirect(level, start):
+            b = next(free)
+            ptrs = array.array('I', [0]) * per_block
+            span = per_block ** (level - 1)
+            for i in xrange(per_block):
+                if start + i * span >= n:
+                    break
+                if level == 1:
+                    ptrs[i] = data_block()
+                else:
+                    ptrs[i] = indirect(level - 1, start + i * span)
+            self.io.write_block(b, ptrs.tostring())
+            return b
+
+        for i in xrange(min(n, e2inode.EXT2_NDIR_BLOCKS)):
+            block[i] = data_block()
+        start = e2inode.EXT2_NDIR_BLOCKS
+        for level in (1, 2, 3):
+            if start >= n:
+                break
+            block[e2inode.EXT2_NDIR_BLOCKS + level - 1] = \
+                indirect(level, start)
+            start += per_block ** level
+        if run[1]:
+            write_run()
+        return block
+
+    def _inode_fields(self, st, size, used, block, links=1):
+        """ fields of a new inode for a file with lstat() result 'st' """
+        fields = {
+            'i_mode': st.st_mode, 'i_uid': st.st_uid & 0xffff,
+            'i_gid': st.st_gid & 0xffff, 'i_size': size & 0xffffffff,
+            'i_atime': int(st.st_atime), 'i_ctime': int(time.time()),
+            'i_mtime': int(st.st_mtime), 'i_links_count': links,
+            'i_blocks': used * (self._blksz / 512),
+            'i_osd2': struct.pack('4x2H4x', st.st_uid >> 16,
+                                  st.st_gid >> 16),
+        }
+        if stat.S_ISREG(st.st_mode):
+            fields['i_dir_acl'] = size >> 32
+        fields.update(zip(e2inode.i_flds[e2inode.EXT2_NDIR_BLOCKS:], block))
+        return fields
+
+    def _write_inode(self, ino_num, fields):
+        """ write a new inode #ino_num, missing 'fields' are zeros """
+        raw = [fields.get(k, 0) for k in e2inode.i_flds]
+        raw[-1] = fields.get('i_osd2', '\0' * 12)
+        buf = e2inode.i_struct.pack(*raw)
+        if self._indsz > len(buf):
+            extra = min(self.sb.d['s_want_extra_isize'],
+                        self._indsz - len(buf))
+            buf += struct.pack('H', extra)
+            buf += '\0' * (self._indsz - len(buf))
+        self.io.write_at(buf, self._inode_offset(ino_num))
+        self._icache.discard(ino_num)
+
+    def _update_inode(self, ino_num, **fields):
+        """ change 'fields' of inode #ino_num on disk """
+        offset = self._inode_offset(ino_num)
+        raw = list(e2inode.i_struct.unpack(
+            str(self.io.read_at(e2inode.i_struct.size, offset))))
+        for k, v in fields.items():
+            raw[e2inode.i_flds.index(k)] = v
+        self.io.write_at(e2inode.i_struct.pack(*raw), offset)
+        self._icache.discard(ino_num)
+        if ino_num == self.root.index:
+            self.root = self._inode(ino_num)
+
+    def _push_file(self, path, st, parent):
+        """ import regular file 'path', return (inode, bytes written) """
+        large_file = e2superblock.EXT2_FEATURE_RO_COMPAT_LARGE_FILE
+        if st.st_size >= 1 << 31 and \
+                not self.sb.d['s_feature_ro_compat'] & large_file:
+            raise Ext2Exception('%s is too large without large_file' % path)
+        ino = self._alloc_inode(parent, False)
+        try:
+            with open(path, 'rb') as f:
+                block, used = self._write_file_blocks(f, st.st_size,
+                                                      self._inode_group(ino))
+        except:
+            self._release_inode(ino, False)
+            raise
+        self._write_inode(ino, self._inode_fields(st, st.st_size, used,
+                                                  block))
+        return ino, st.st_size
+
+    def _push_symlink(self, target, st, parent):
+        if len(target) >= self._blksz:
+            raise Ext2Exception('Symlink target is too long: %s' % target)
+        ino = self._alloc_inode(parent, False)
+        used = 0
+        if len(target) < struct.intsz * e2inode.EXT2_N_BLOCKS:
+            block = struct.unpack('15I', target.ljust(60, '\0'))
+        else:
+            block = [0] * e2inode.EXT2_N_BLOCKS
+            try:
+                block[0] = self._alloc_blocks(1, self._inode_group(ino))[0][0]
+            except:
+                self._release_inode(ino, False)
+                raise
+            self.io.write_block(block[0], target.ljust(self._blksz, '\0'))
+            used = 1
+        self._write_inode(ino, self._inode_fields(st, len(target), used,
+                                                  block))
+        return ino
+
+    def _push_special(self, st, parent):
+        """ a device node, fifo or socket """
+        ino = self._alloc_inode(parent, False)
+        block = [0] * e2inode.EXT2_N_BLOCKS
+        if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+            major, minor = os.major(st.st_rdev), os.minor(st.st_rdev)
+            if major < 256 and minor < 256:
+                block[0] = (major << 8) | minor
+            else:
+                block[1] = (minor & 0xff) | (major << 8) | \
+                    ((minor & ~0xff) << 12)
+        self._write_inode(ino, self._inode_fields(st, 0, 0, block))
+        return ino
+
+    def _push_dir(self, st, parent):
+        """ make an empty directory (entries '.' and '..' only) with the
+        attributes of 'st' in directory #parent, return its inode """
+        ino = self._alloc_inode(parent, True)
+        block = [0] * e2inode.EXT2_N_BLOCKS
+        try:
+            block[0] = self._alloc_blocks(1, self._inode_group(ino))[0][0]
+        except:
+            self._release_inode(ino, True)
+            raise
+        buf = bytearray(self._blksz)
+        self._put_dentry(buf, 0, '.', ino, stat.S_IFDIR, 12)
+        self._put_dentry(buf, 12, '..', parent, stat.S_IFDIR,
+                         self._blksz - 12)
+        self.io.write_block(block[0], buf)
+        self._write_inode(ino, self._inode_fields(st, self._blksz, 1,
+                                                  block, links=2))
+        self._update_inode(parent, i_links_count=self._inode(parent).nlink + 1)
+        return ino
+
+    def _put_dentry(self, buf, offset, name, ino_num, mode, size):
+        ftype = 0
+        if self.sb.has_filetype():
+            ftype = e2dentry.stattype.index(stat.S_IFMT(mode))
+        e2dentry.d_struct.pack_into(buf, offset, ino_num, size, len(name),
+                                    ftype)
+        start = offset + e2dentry.fmt_size
+        buf[start:start + len(name)] = name
+
+    @staticmethod
+    def _check_name(name):
+        if not name or '/' in name or len(name) > 255:
+            raise Ext2Exception('Invalid file name "%s"' % name)
+
+    def _add_dentry(self, dir_ino, name, ino_num, mode):
+        """ add entry 'name' for inode #ino_num to directory #dir_ino.
+        It goes to the first gap big enough for it, searching from the
+        block of the last added entry, or to a new block at the end.
+        An htree index of the directory is dropped by clearing
+        EXT2_INDEX_FL: the directory stays valid as a linear one (the
+        index blocks look like empty entries), e2fsck -D can rebuild it.
+        """
+        self._check_name(name)
+        d = self._inode(dir_ino)
+        need = e2dentry.rec_len(len(name))
+        for fileblock in xrange(self._dir_hint.get(dir_ino, 0),
+                                d.n_blocks()):
+            block_num = d._map(fileblock)
+            if not block_num:
+                continue
+            buf = bytearray(str(self.io.read_block(block_num)))
+            offset = 0
+            while offset < len(buf):
+                entry = e2dentry(buf, offset)
+                used = e2dentry.rec_len(entry.namelen) if entry.inode else 0
+                if entry.size - used >= need:
+                    if used:
+                        struct.pack_into('H', buf, offset + 4, used)
+                    self._put_dentry(buf, offset + used, name, ino_num, mode,
+                                     entry.size - used)
+                    self.io.write_block(block_num, buf)
+                    break
+                offset += entry.size
+            else:
+                continue
+            break
+        else:
+            # no room: append a block
+            fileblock = d.n_blocks()
+            block_num = self._alloc_blocks(1, self._inode_group(dir_ino))[0][0]
+            buf = bytearray(self._blksz)
+            self._put_dentry(buf, 0, name, ino_num, mode, self._blksz)
+            self.io.write_block(block_num, buf)
+            block, meta = self._set_block(d, fileblock, block_num)
+            fields = dict(zip(e2inode.i_flds[e2inode.EXT2_NDIR_BLOCKS:],
+                              block))
+            self._update_inode(dir_ino, i_size=d.n_length + self._blksz,
+                               i_blocks=d.blocks +
+                               (1 + meta) * (self._blksz / 512), **fields)
+
+        self._dir_hint[dir_ino] = fileblock
+        if d.flags & e2directory.EXT2_INDEX_FL:
+            self._update_inode(dir_ino,
+                               i_flags=d.flags & ~e2directory.EXT2_INDEX_FL)
+        self.invalidate_dir(dir_ino)
+
+    def _set_block(self, inode, fileblock, block_num):
+        """ map 'fileblock' of 'inode' to 'block_num', allocating missing
+        indirect blocks; return (the inode's new block pointers, number of
+        indirect blocks allocated) """
+        block = list(inode.block)
+        if fileblock < e2inode.EXT2_NDIR_BLOCKS:
+            block[fileblock] = block_num
+            return block, 0
+        per_block = self._blksz / struct.intsz
+        goal = self._inode_group(inode.index)
+        rest = fileblock - e2inode.EXT2_NDIR_BLOCKS
+        for level in (1, 2, 3):
+            span = per_block ** level
+            if rest < span:
+                break
+            rest -= span
+        else:
+            raise Ext2Exception('File block %d is out of range' % fileblock)
+
+        new = 0
+        slot = e2inode.EXT2_NDIR_BLOCKS + level - 1
+        if not block[slot]:
+            block[slot] = self._zeroed_block(goal)
+            new += 1
+        ptr = block[slot]
+        while True:
+            span /= per_block
+            ptrs = u32_array(str(self.io.read_block(ptr)))
+            i, rest = divmod(rest, span)
+            if span == 1:
+                ptrs[i] = block_num
+                self.io.write_block(ptr, ptrs.tostring())
+                return block, new
+            if not ptrs[i]:
+                ptrs[i] = self._zeroed_block(goal)
+                new += 1
+                self.io.write_block(ptr, ptrs.tostring())
+            ptr = ptrs[i]
+
+    def _zeroed_block(self, goal_group):
+        block_num = self._alloc_blocks(1, goal_group)[0][0]
+        self.io.write_block(block_num, '\0' * self._blksz)
+        return block_num
+
+
+# the file system of a process of the iter_inodes() pool
+_scan_fs = None
+
+
+def _scan_init(filename, use_mmap):
+    global _scan_fs
+    _scan_fs = ext2fs(filename, use_mmap=use_mmap)
+
+
+def _scan_group(args):
+    """ (inode number, packed record, extents or None) of the used
+    inodes of a group, for iter_inodes() """
+    group, extents = args
+    return [(inode.index, e2inode.i_struct.pack(*inode._raw),
+             inode._extents)
+            for inode in _scan_fs._group_inodes(group, extents)]
+
+
+# units of find -size, as in find(1)
+size_units = {'c': 1, 'w': 2, 'b': 512, 'k': 1024, 'M': 1024 ** 2,
+              'G': 1024 ** 3}
 
 
 def usage():
@@ -591,6 +2826,13 @@ def usage():
     print '   info'
     print '   ls <path>'
     print '   cp <from/image> <outside/file>'
+    print '   cptree <from/image/dir> <outside/dir>'
+    print '   push <outside/file/or/dir> <to/image/path>'
+    print '   freespace [-g]        (-g: every block group too)'
+    print '   du [-s] [path]'
+    print '   index <index/file>    (make an index for ext2fs(index=...))'
+    print '   find [path] [-name PATTERN] [-type TYPE] [-size [+-]N[cwbkMG]]'
+    print '        [-mtime [+-]DAYS]  (-size: 512-byte blocks by default)'
 
 if '__main__' == __name__:
     import sys
@@ -600,7 +2842,7 @@ if '__main__' == __name__:
 
     imgfile = sys.argv[1]
     try:
-        e2fs = ext2fs(imgfile)
+        e2fs = ext2fs(imgfile, writable=(sys.argv[2] == 'push'))
     except IOError:
         print 'No such file: %s' % imgfile
         sys.exit(-2)
@@ -621,6 +2863,94 @@ if '__main__' == __name__:
               % (time_format(e2fs.sb.d['s_lastcheck']),
                  time_format(e2fs.sb.d['s_checkinterval'])))
         print('')
+    elif sys.argv[2] == 'freespace':
+        report = e2fs.space_report()
+        blksz = e2fs.sb.block_size()
+        if '-g' in sys.argv[3:]:
+            print('group  free blocks  free inodes   runs  largest  frag')
+            for st in report['groups']:
+                print('%(group)5d  %(free_blocks)11d  %(free_inodes)11d  '
+                      '%(free_runs)6d  %(largest_free)7d  '
+                      '%(fragmentation).2f' % st)
+            print('')
+        print('Free: %d blocks (%d bytes) in %d runs, %d inodes'
+              % (report['free_blocks'], report['free_blocks'] * blksz,
+                 report['free_runs'], report['free_inodes']))
+        print('Largest free extent: %d blocks, fragmentation: %.2f'
+              % (report['largest_free'], report['fragmentation']))
+        print('Run length   runs   blocks')
+        for length in sorted(report['histogram']):
+            runs, blocks = report['histogram'][length]
+            print('%10d %6d %8d' % (length, runs, blocks))
+        for message in report['mismatches']:
+            print('Mismatch: %s' % message)
+    elif sys.argv[2] == 'index':
+        if len(sys.argv) < 4:
+            usage()
+        else:
+            started = time.time()
+            e2fs.build_index(sys.argv[3])
+            print('%s: %d bytes in %.2f s' % (sys.argv[3],
+                                              os.path.getsize(sys.argv[3]),
+                                              time.time() - started))
+    elif sys.argv[2] == 'du':
+        args = [a for a in sys.argv[3:] if a != '-s']
+        top = args[0] if args else '/'
+        sizes = e2fs.du(top)
+        top = '/' + top.strip('/')
+        if '-s' not in sys.argv[3:]:
+            for path in sorted(sizes, reverse=True):
+                if path != top:
+                    print('%d\t%s' % (sizes[path] / 1024, path))
+        print('%d\t%s' % (sizes[top] / 1024, top))
+    elif sys.argv[2] == 'find':
+        args = sys.argv[3:]
+        top = '/'
+        if args and not args[0].startswith('-'):
+            top = args.pop(0)
+        conds = {}
+        try:
+            while args:
+                opt, value = args[0], args[1]
+                args = args[2:]
+                sign = value[0] if value[0] in '+-' else ''
+                number = value[len(sign):]
+                if opt == '-name':
+                    conds['name'] = value
+                elif opt == '-type':
+                    conds['filetype'] = '-' if value == 'f' else value
+                elif opt == '-size':
+                    # as in find(1): 512-byte blocks by default, the size
+                    # of a file is rounded up to the unit
+                    unit = 512
+                    if number[-1] in size_units:
+                        unit = size_units[number[-1]]
+                        number = number[:-1]
+                    n = int(number)
+                    if sign == '+':
+                        conds['min_size'] = n * unit + 1
+                    elif sign == '-':
+                        conds['max_size'] = (n - 1) * unit
+                    else:
+                        conds['min_size'] = (n - 1) * unit + 1
+                        conds['max_size'] = n * unit
+                elif opt == '-mtime':
+                    when = time.time() - int(number) * 86400
+                    if sign == '-':
+                        conds['newer'] = when
+                    elif sign == '+':
+                        # more than N whole days ago, as in find(1)
+                        conds['older'] = when - 86400
+                    else:
+                        conds['newer'] = when - 86400
+                        conds['older'] = when
+                else:
+                    raise ValueError(opt)
+        except (IndexError, ValueError):
+            usage()
+            sys.exit(-1)
+        for path, inode in e2fs.find(top, **conds):
+            print(path)
     elif sys.argv[2] == 'ls':
         if len(sys.argv) < 4:
             usage()
@@ -630,6 +2960,34 @@ if '__main__' == __name__:
         if len(sys.argv) < 5:
             usage()
         else:
-            e2fs.pull(sys.argv[3], sys.argv[4])
+            copied, seconds = e2fs.pull(sys.argv[3], sys.argv[4])
+            print('%d bytes copied in %.2f s (%.1f MB/s)'
+                  % (copied, seconds, copied / max(seconds, 1e-6) / 1e6))
+    elif sys.argv[2] == 'cptree':
+        if len(sys.argv) < 5:
+            usage()
+        else:
+            last_report = [0]
+
+            def report(files_done, files, bytes_done, total_bytes):
+                now = time.time()
+                if now - last_report[0] > 0.5 or files_done == files:
+                    last_report[0] = now
+                    sys.stderr.write('\r%d/%d files, %d/%d MB'
+                                     % (files_done, files, bytes_done >> 20,
+                                        total_bytes >> 20))
+
+            totals = e2fs.pull_tree(sys.argv[3], sys.argv[4], progress=report)
+            sys.stderr.write('\n')
+            print('%(dirs)d directories, %(files)d files, %(links)d links, '
+                  '%(bytes)d bytes in %(seconds).2f s' % totals)
+    elif sys.argv[2] == 'push':
+        if len(sys.argv) < 5:
+            usage()
+        else:
+            copied, seconds = e2fs.push(sys.argv[3], sys.argv[4])
+            e2fs.umount()
+            print('%d bytes copied in %.2f s (%.1f MB/s)'
+                  % (copied, seconds, copied / max(seconds, 1e-6) / 1e6))
     else:
         usage()
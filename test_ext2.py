@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+""" tests of ext2.py on images made with mke2fs -d.
+$ python -m unittest test_ext2
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from ext2 import *
+
+
+def have_mke2fs():
+    try:
+        with open(os.devnull, 'w') as null:
+            subprocess.call(['mke2fs', '-V'], stdout=null, stderr=null)
+    except OSError:
+        return False
+    return True
+
+
+class LruTest(unittest.TestCase):
+    def test_put_too_big_drops_old_value(self):
+        cache = e2lru(10, len)
+        cache.put('a', 'old')
+        cache.put('a', 'x' * 11)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.used, 0)
+
+
+@unittest.skipUnless(have_mke2fs(), 'mke2fs is needed to make images')
+class IndexReadTest(unittest.TestCase):
+    # 1K blocks: blocks from 12 + 256 on go through the double indirect
+    # block
+    data = ''.join(chr(i * 7 % 251) for i in xrange(3 * 1024 * 1024))
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        tree = os.path.join(cls.tmp, 'tree')
+        os.makedirs(tree)
+        with open(os.path.join(tree, 'big.bin'), 'wb') as f:
+            f.write(cls.data)
+        cls.image = os.path.join(cls.tmp, 'ext2.img')
+        with open(os.devnull, 'w') as null:
+            subprocess.check_call(['mke2fs', '-q', '-F', '-t', 'ext2',
+                                   '-b', '1024', '-d', tree, cls.image,
+                                   '8M'], stdout=null, stderr=null)
+        cls.index = os.path.join(cls.tmp, 'ext2.idx')
+        fs = ext2fs(cls.image)
+        e2index.build(fs, cls.index)
+        fs.io.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def test_read_without_indirect_blocks(self):
+        fs = ext2fs(self.image, index=self.index)
+        inode = fs._as_inode('/big.bin')
+        self.assertTrue(inode.block[e2inode.EXT2_NDIR_BLOCKS + 1])
+        before = fs.io.stats()['block_reads']
+        self.assertEqual(fs.read(inode, 0, len(self.data)), self.data)
+        buf = bytearray(100000)
+        self.assertEqual(fs.readinto(inode, 2 * 1024 * 1024 + 17, buf),
+                         len(buf))
+        start = 2 * 1024 * 1024 + 17
+        self.assertEqual(str(buf), self.data[start:start + len(buf)])
+        self.assertEqual(fs.io.stats()['block_reads'], before)
+        fs.io.close()
+
+    def test_read_through_indirect_blocks(self):
+        fs = ext2fs(self.image)
+        inode = fs._as_inode('/big.bin')
+        before = fs.io.stats()['block_reads']
+        self.assertEqual(fs.read(inode, 0, len(self.data)), self.data)
+        self.assertGreater(fs.io.stats()['block_reads'], before)
+        fs.io.close()
+
+
+if __name__ == '__main__':
+    unittest.main()